@@ -1,14 +1,21 @@
 from itertools import product
 
 import asyncio
+import atexit
 from collections import namedtuple
-from inspect import signature, isfunction
+from functools import lru_cache
+from inspect import signature
+import hashlib
+import json
 import logging
 from pathlib import Path
 import shutil
 import subprocess
 import sys
 import os
+from types import MappingProxyType
+import re
+import shlex
 
 from typing import Sequence, Dict, Union, Iterable, Mapping, Any, IO, Tuple, Optional, List
 
@@ -85,6 +92,9 @@ def with_power_session(f=None):
     def _decorator(f):
         @wraps(f)
         def _f_wrapper(**kwargs):
+            # patch nox popen so that commands can be TEE-ed to log files
+            patch_popen()
+
             # patch the session arg
             PowerSession.patch(kwargs['session'])
 
@@ -100,6 +110,8 @@ class PowerSession(Session):
     """
     Our nox session improvements
     """
+    # no new attribute, so that the class of existing `Session` objects can be switched to this one (see `patch`)
+    __slots__ = ()
 
     # ------------ commandline runners -----------
 
@@ -130,7 +142,7 @@ class PowerSession(Session):
         """
         An improvement of session.run that is able to
 
-         - support multiline strings
+         - support multiline strings. Each line is split into arguments with `shlex.split`, so quotes are supported
          - use a log file
 
         :param cmds:
@@ -138,8 +150,8 @@ class PowerSession(Session):
         :param kwargs:
         :return:
         """
-        for cmdline in (line for line in cmds.splitlines() if line):
-            self.run2(cmdline, logfile=logfile, **kwargs)
+        for args in split_multiline_cmds(cmds):
+            self.run(*args, logfile=logfile, **kwargs)
 
     # ------------ requirements installers -----------
 
@@ -192,14 +204,15 @@ class PowerSession(Session):
 
         """
 
-        # Read requirements from pyproject.toml
+        # Read requirements from pyproject.toml (note: the parsed files are cached, see `read_pyproject_toml`)
         toml_setup_reqs, toml_use_conda_for = read_pyproject_toml()
         if setup:
             self.install_any("pyproject.toml#build-system", toml_setup_reqs,
                              use_conda_for=toml_use_conda_for, versions_dct=versions_dct)
 
-        # Read test requirements from setup.cfg
-        setup_cfg = read_setuptools_cfg()
+        # Read test requirements from setup.cfg, only if needed
+        if setup or install or tests or extras:
+            setup_cfg = read_setuptools_cfg()
         if setup:
             self.install_any("setup.cfg#setup_requires", setup_cfg.setup_requires,
                              use_conda_for=toml_use_conda_for, versions_dct=versions_dct)
@@ -223,8 +236,17 @@ class PowerSession(Session):
                     use_conda_for: Sequence[str] = (),
                     versions_dct: Dict[str, str] = None,
                     logfile: Union[bool, str, Path] = True,
+                    force: bool = False,
                     ):
-        """Install the `pkgs` provided with `session.install(*pkgs)`, except for those present in `use_conda_for`"""
+        """Install the `pkgs` provided with `session.install(*pkgs)`, except for those present in `use_conda_for`
+
+        If the exact same requirements were already installed in this session's environment (this happens when the
+        environment is reused), installation is skipped. Use `force=True` to install anyway.
+        """
+
+        if not pkgs:
+            # nothing to install
+            return
 
         nox_logger.debug("\nAbout to install *%s* requirements: %s.\n "
                          "Conda pkgs are %s" % (phase_name, pkgs, use_conda_for))
@@ -233,23 +255,40 @@ class PowerSession(Session):
         if versions_dct is None:
             versions_dct = dict()
         pkgs = [pkg + versions_dct.get(pkg, "") for pkg in pkgs if versions_dct.get(pkg, "") != DONT_INSTALL]
-
-        # install on conda... if the session uses conda backend
+        if not pkgs:
+            # all packages were marked as DONT_INSTALL
+            return
+
+        # skip if these requirements were already installed in this environment
+        install_key = get_install_key(pkgs, use_conda_for)
+        install_cache = read_install_cache(self.virtualenv)
+        if not force and install_cache.get(phase_name) == install_key:
+            nox_logger.info("[%s] Requirements already installed, skipping: %s" % (phase_name, pkgs))
+            return
+
+        # split between conda and pip... if the session uses conda backend
         if not isinstance(self.virtualenv, nox.virtualenv.CondaEnv):
-            conda_pkgs = []
+            conda_pkgs, pip_pkgs = [], list(pkgs)
         else:
-            conda_pkgs = [pkg_req for pkg_req in pkgs if any(get_req_pkg_name(pkg_req) == c for c in use_conda_for)]
-            if len(conda_pkgs) > 0:
-                nox_logger.info("[%s] Installing requirements with conda: %s" % (phase_name, conda_pkgs))
-                self.conda_install2(*conda_pkgs, logfile=logfile)
-
-        pip_pkgs = [pkg_req for pkg_req in pkgs if pkg_req not in conda_pkgs]
-        # safety: make sure that nothing went modified or forgotten
-        assert set(conda_pkgs).union(set(pip_pkgs)) == set(pkgs)
+            use_conda_for = frozenset(use_conda_for)
+            conda_pkgs, pip_pkgs = [], []
+            for pkg_req in pkgs:
+                (conda_pkgs if get_req_pkg_name(pkg_req) in use_conda_for else pip_pkgs).append(pkg_req)
+
+        # install on conda
+        if len(conda_pkgs) > 0:
+            nox_logger.info("[%s] Installing requirements with conda: %s" % (phase_name, conda_pkgs))
+            self.conda_install2(*conda_pkgs, logfile=logfile)
+
+        # install on pip
         if len(pip_pkgs) > 0:
             nox_logger.info("[%s] Installing requirements with pip: %s" % (phase_name, pip_pkgs))
             self.install2(*pip_pkgs, logfile=logfile)
 
+        # remember that these requirements are installed
+        install_cache[phase_name] = install_key
+        write_install_cache(self.virtualenv, install_cache)
+
     def conda_install2(self,
                        *conda_pkgs,
                        logfile: Union[bool, str, Path] = True,
@@ -282,30 +321,30 @@ class PowerSession(Session):
         """Return the session id"""
         return Path(self.bin).name
 
-    @classmethod
-    def is_power_session(cls, session: Session):
-        return PowerSession.install2.__name__ in session.__dict__
-
     @classmethod
     def patch(cls, session: Session):
         """
-        Add all methods from this class to the provided object.
+        Turn the provided session object into an instance of this class, so that it has all its methods.
         Note that we could instead have created a proper proxy... but complex for not a lot of benefit.
         :param session:
         :return:
         """
-        if not cls.is_power_session(session):
-            for m_name, m in cls.__dict__.items():
-                if not isfunction(m):
-                    continue
-                if m is cls.patch:
-                    continue
-                if not hasattr(session, m_name):
-                    setattr(session.__class__, m_name, m)
+        if not isinstance(session, cls):
+            session.__class__ = cls
 
         return True
 
 
+@lru_cache()
+def split_multiline_cmds(cmds: str) -> Tuple[Tuple[str, ...], ...]:
+    """
+    Splits a multiline string into commands (one per non-empty line), each command being a tuple of arguments.
+    On windows the non-POSIX mode of `shlex` is used, so that the backslashes in paths are not seen as escapes.
+    """
+    posix = os.name != 'nt'
+    return tuple(tuple(shlex.split(line, posix=posix)) for line in cmds.splitlines() if line.strip())
+
+
 # ------------- requirements related
 
 
@@ -315,25 +354,46 @@ def read_pyproject_toml():
 
      - a list of setup requirements from [build-system] requires
      - sub-list of these requirements that should be installed with conda, from [tool.my_conda] conda_packages
+
+    The result is cached as long as the file is not modified.
     """
     if os.path.exists("pyproject.toml"):
-        import toml
-        nox_logger.debug("\nA `pyproject.toml` file exists. Loading it.")
-        pyproject = toml.load("pyproject.toml")
-        requires = pyproject['build-system']['requires']
-        conda_pkgs = pyproject['tool']['conda']['conda_packages']
-        return requires, conda_pkgs
+        return _read_pyproject_toml(os.path.getmtime("pyproject.toml"))
     else:
         raise FileNotFoundError("No `pyproject.toml` file exists. No dependency will be installed ...")
 
 
+@lru_cache(maxsize=1)
+def _read_pyproject_toml(mtime):
+    """Cached implementation of `read_pyproject_toml`. `mtime` is only used as the cache key."""
+    try:
+        import tomllib  # python 3.11+
+    except ImportError:
+        import tomli as tomllib
+    nox_logger.debug("\nA `pyproject.toml` file exists. Loading it.")
+    with open("pyproject.toml", "rb") as f:
+        pyproject = tomllib.load(f)
+    requires = pyproject['build-system']['requires']
+    conda_pkgs = pyproject['tool']['conda']['conda_packages']
+    return requires, conda_pkgs
+
+
 SetupCfg = namedtuple('SetupCfg', ('setup_requires', 'install_requires', 'tests_requires', 'extras_require'))
 
 
 def read_setuptools_cfg():
     """
     Reads the `setup.cfg` file and extracts the various requirements lists
+
+    The result is cached as long as the file is not modified.
     """
+    mtime = os.path.getmtime("setup.cfg") if os.path.exists("setup.cfg") else None
+    return _read_setuptools_cfg(mtime)
+
+
+@lru_cache(maxsize=1)
+def _read_setuptools_cfg(mtime):
+    """Cached implementation of `read_setuptools_cfg`. `mtime` is only used as the cache key."""
     # see https://stackoverflow.com/a/30679041/7262247
     from setuptools import Distribution
     dist = Distribution()
@@ -344,6 +404,47 @@ def read_setuptools_cfg():
                     extras_require=dist.extras_require)
 
 
+INSTALL_CACHE_FILE_NAME = ".nox_install_cache.json"
+
+
+def get_install_key(pkgs: Sequence[str],
+                    use_conda_for: Sequence[str] = ()
+                    ) -> str:
+    """Return a hash identifying a list of requirements to install, to be stored in the install cache"""
+    return hashlib.sha1(json.dumps([sorted(pkgs), sorted(use_conda_for)]).encode("utf-8")).hexdigest()
+
+
+def get_install_cache_file(venv) -> Optional[Path]:
+    """Return the path to the install cache file in virtual environment `venv`, or None if it has no location"""
+    location = getattr(venv, "location", None)
+    return Path(location) / INSTALL_CACHE_FILE_NAME if location else None
+
+
+def read_install_cache(venv) -> Dict[str, str]:
+    """
+    Reads the install cache of virtual environment `venv`, that is a dictionary {phase_name: install_key}.
+    An empty dictionary is returned if it does not exist or can not be read.
+    """
+    cache_file = get_install_cache_file(venv)
+    if cache_file is None or not cache_file.is_file():
+        return dict()
+    try:
+        return json.loads(cache_file.read_text())
+    except ValueError:
+        nox_logger.warning("Ignoring invalid install cache file %s" % cache_file)
+        return dict()
+
+
+def write_install_cache(venv, install_cache: Dict[str, str]):
+    """Writes the install cache of virtual environment `venv` (see `read_install_cache`)"""
+    cache_file = get_install_cache_file(venv)
+    if cache_file is not None and cache_file.parent.exists():
+        cache_file.write_text(json.dumps(install_cache, indent=2))
+
+
+PKG_NAME_SUFFIX_PATTERN = re.compile(r"[<>=;!~\[].*")
+
+
 def get_req_pkg_name(r):
     """Return the package name part of a python package requirement.
 
@@ -351,7 +452,7 @@ def get_req_pkg_name(r):
     "funcsigs;python<'3.5'" will return "funcsigs"
     "pytest>=3" will return "pytest"
     """
-    return r.replace('<', '=').replace('>', '=').replace(';', '=').split("=")[0]
+    return PKG_NAME_SUFFIX_PATTERN.sub("", r).strip()
 
 
 # ------------- log related
@@ -418,6 +519,9 @@ def with_logfile(logs_dir: Path,
     return _decorator
 
 
+_CURRENT_LOGFILE_HANDLER = None
+
+
 def log_to_file(file_path: Union[str, Path]
                 ):
     """
@@ -427,12 +531,14 @@ def log_to_file(file_path: Union[str, Path]
     :param file_path:
     :return:
     """
+    global _CURRENT_LOGFILE_HANDLER
     for h in list(nox_logger.handlers):
         if isinstance(h, logging.FileHandler):
             h.close()
             nox_logger.removeHandler(h)
     fh = logging.FileHandler(str(file_path), mode='w')
     nox_logger.addHandler(fh)
+    _CURRENT_LOGFILE_HANDLER = fh
     return fh
 
 
@@ -440,6 +546,14 @@ def get_current_logfile_handler():
     """
     Returns the current unique log file handler (see `log_to_file`)
     """
+    return _CURRENT_LOGFILE_HANDLER
+
+
+def _find_logfile_handler():
+    """
+    Returns the first file handler found in the nox logger handlers, if any. Contrary to
+    `get_current_logfile_handler` this also finds handlers that were not added with `log_to_file`.
+    """
     for h in list(nox_logger.handlers):
         if isinstance(h, logging.FileHandler):
             return h
@@ -448,11 +562,15 @@ def get_current_logfile_handler():
 
 def get_log_file_stream():
     """
-    Returns the output stream for the current log file handler if any (see `log_to_file`)
+    Returns the binary output stream for the current log file handler if any (see `log_to_file`).
+
+    This is the buffer underlying the handler's text stream, so that bytes can be written to the log file without
+    going through the text encoding layer. Since the handler flushes its text stream after each record, both can be
+    safely used in turn.
     """
     h = get_current_logfile_handler()
     if h is not None:
-        return h.stream
+        return h.stream.buffer
     return None
 
 
@@ -461,10 +579,12 @@ def remove_file_logger():
     Closes and detaches the current logfile handler
     :return:
     """
+    global _CURRENT_LOGFILE_HANDLER
     h = get_current_logfile_handler()
     if h is not None:
         h.close()
         nox_logger.removeHandler(h)
+        _CURRENT_LOGFILE_HANDLER = None
 
 
 # ------------ environment grid / parametrization related
@@ -536,6 +656,9 @@ def nox_session_with_grid(python = None,
     if has_parameter and not grid_param_name:
         raise ValueError("You must provide a grid parameter name when the env keys are tuples.")
 
+    # all validation is done: freeze the parameters so that they can safely be shared by all sessions
+    envs = {env_id: MappingProxyType(dict(env_params)) for env_id, env_params in envs.items()}
+
     def _decorator(f):
         s_name = name if name is not None else f.__name__
         for pyv, _param in product(all_python, all_params):
@@ -623,8 +746,8 @@ def rm_folder(folder: Union[str, Path]
 # --- the patch of popen able to tee to logfile --
 
 
-import nox.popen as nox_popen_module
-orig_nox_popen = nox_popen_module.popen
+# the original nox popen, set by `patch_popen`
+orig_nox_popen = None
 
 
 class LogFileStreamCtx:
@@ -682,7 +805,7 @@ def patched_popen(
         if logfile is True:
             ctx = LogFileStreamCtx
         else:
-            ctx = lambda _: open(logfile, "a")
+            ctx = lambda _: open(logfile, "ab")
 
         with ctx(logfile_stream) as log_file_stream:
             if silent and stdout is not None:
@@ -707,26 +830,39 @@ def patched_popen(
 
             # define the async coroutines
             async def async_popen():
-                process = await asyncio.create_subprocess_exec(*args, env=env, stdout=asyncio.subprocess.PIPE,
-                                                               stderr=asyncio.subprocess.PIPE, **kwargs)
+                process = await asyncio.create_subprocess_exec(resolve_executable(args[0], env), *args[1:], env=env,
+                                                               stdout=asyncio.subprocess.PIPE,
+                                                               stderr=asyncio.subprocess.PIPE,
+                                                               limit=STREAM_BUFFER_LIMIT, **kwargs)
 
                 # bind the out and err streams - see https://stackoverflow.com/a/59041913/7262247
-                # to mimic nox behaviour we only use a single capturing list
+                # to mimic nox behaviour we only use a single capturing list. It contains raw lines, decoded at the end
                 outlines = []
-                await asyncio.wait([
+
+                def _tee_out(l):
                     # process out is only redirected to STDOUT if not silent
-                    _read_stream(process.stdout, lambda l: tee(l, sinklist=outlines, sinkstream=log_file_stream,
-                                                               quiet=silent, verbosepipe=sys.stdout)),
+                    tee(l, sinklist=outlines, sinkstream=log_file_stream, quiet=silent, verbosepipe=sys.stdout)
+
+                def _tee_err(l):
                     # process err is always redirected to STDOUT (quiet=False) with a specific label
-                    _read_stream(process.stderr, lambda l: tee(l, sinklist=outlines, sinkstream=log_file_stream,
-                                                               quiet=False, verbosepipe=sys.stdout, label="ERR:"))
-                ])
+                    tee(l, sinklist=outlines, sinkstream=log_file_stream, quiet=False, verbosepipe=sys.stdout,
+                        label="ERR:")
+
+                # tee does not flush each line: flush the sinks periodically instead. Note: the streams are read
+                # while the process runs (not with `communicate()`) so that the log file is written live, even if
+                # silent: a hung or killed command still leaves its output in the log
+                flusher = asyncio.ensure_future(_flush_periodically((log_file_stream, sys.stdout)))
+                try:
+                    # note: gather (contrary to wait) propagates the exceptions raised while reading the streams
+                    await asyncio.gather(_read_stream(process.stdout, _tee_out),
+                                         _read_stream(process.stderr, _tee_err))
+                finally:
+                    flusher.cancel()
                 return_code = await process.wait()  # make sur the process has ended and retrieve its return code
                 return return_code, outlines
 
             # run the coroutine in the event loop
-            loop = asyncio.get_event_loop()
-            return_code, outlines = loop.run_until_complete(async_popen())
+            return_code, outlines = get_popen_event_loop().run_until_complete(async_popen())
 
             # just in case, flush everything
             log_file_stream.flush()
@@ -735,7 +871,7 @@ def patched_popen(
 
             if silent:
                 # same behaviour as in nox: this will be passed to the logger, and it will act depending on verbose flag
-                out = "\n".join(outlines) if len(outlines) > 0 else ""
+                out = b"\n".join(outlines).decode('utf-8', 'replace')
             else:
                 # already written to stdout, no need to capture
                 out = ""
@@ -743,57 +879,126 @@ def patched_popen(
             return return_code, out
 
 
-async def _read_stream(stream, callback):
-    """Helper async coroutine to read from a stream line by line and write them in callback"""
-    while True:
-        line = await stream.readline()
-        if line:
-            callback(line)
+_EXECUTABLES_CACHE = dict()
+
+
+def resolve_executable(exe: str, env: Mapping[str, str] = None) -> str:
+    """
+    Returns the absolute path of executable `exe`, looked up in the PATH of `env` (or of `os.environ` if None).
+    Resolved paths are cached, per PATH value. If `exe` can not be found, it is returned unchanged.
+    """
+    if os.path.isabs(exe):
+        return exe
+
+    path = (env if env is not None else os.environ).get("PATH")
+    try:
+        return _EXECUTABLES_CACHE[(exe, path)]
+    except KeyError:
+        resolved = _EXECUTABLES_CACHE[(exe, path)] = shutil.which(exe, path=path) or exe
+        return resolved
+
+
+_POPEN_LOOP = None
+
+
+def get_popen_event_loop():
+    """
+    Returns the event loop used by `patched_popen`. It is created once (by `patch_popen`) and reused for all commands,
+    and closed when the interpreter exits.
+    """
+    global _POPEN_LOOP
+    if _POPEN_LOOP is None or _POPEN_LOOP.is_closed():
+        if 'win32' in sys.platform:
+            # Windows: a proactor loop is needed for subprocess support. We create it explicitly rather than setting
+            # the global event loop policy, so as not to override any policy set by the user.
+            # see https://docs.python.org/3/library/asyncio-platforms.html#subprocess-support-on-windows
+            _POPEN_LOOP = asyncio.ProactorEventLoop()
         else:
+            _POPEN_LOOP = asyncio.new_event_loop()
+        # set it as the current loop so that the child watcher is attached to it on python < 3.8
+        asyncio.set_event_loop(_POPEN_LOOP)
+        atexit.register(_POPEN_LOOP.close)
+    return _POPEN_LOOP
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_BUFFER_LIMIT = 1024 * 1024
+
+
+async def _read_stream(stream, callback, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Helper async coroutine to read from a stream line by line and write them in callback.
+
+    The stream is read by chunks of at most `chunk_size` bytes (instead of line by line) to limit the number of
+    event loop iterations. The last incomplete line of a chunk is kept and prepended to the next one.
+    """
+    leftover = b""
+    while True:
+        data = await stream.read(chunk_size)
+        if not data:
             break
+        lines = (leftover + data).split(b"\n")
+        leftover = lines.pop()
+        for line in lines:
+            callback(line)
+
+    if leftover:
+        callback(leftover)
+
+
+TEE_FLUSH_INTERVAL = 0.1  # in seconds
+
+
+async def _flush_periodically(streams, interval=TEE_FLUSH_INTERVAL):
+    """Helper async coroutine to flush all `streams` every `interval` seconds, until cancelled"""
+    while True:
+        await asyncio.sleep(interval)
+        for s in streams:
+            s.flush()
 
 
 def tee(linebytes, sinklist, sinkstream, verbosepipe, quiet, label=""):
     """
-    Helper routine to read a line, decode it, and append it to several sinks:
+    Helper routine to read a line and append it to several sinks:
 
-     - an optional `sinklist` list that will receive the decoded string in its "append" method
-     - an optional `sinkstream` stream that will receive the decoded string in its "writelines" method
+     - an optional `sinklist` list that will receive the raw line (not decoded) in its "append" method
+     - an optional `sinkstream` binary stream that will receive the raw line (not decoded) in its "write" method
      - an optional `verbosepipe` stream that will receive only when quiet=False, the decoded string through a print
 
     append it to the sink, and if quiet=False, write it to pipe too.
+
+    Note that the streams are not flushed here, so that writes can be buffered: this is the responsibility of the
+    caller (see `_flush_periodically`).
     """
-    line = linebytes.decode('utf-8').rstrip()
+    linebytes = linebytes.rstrip()
 
     if sinklist is not None:
-        sinklist.append(line)
+        sinklist.append(linebytes)
 
     if sinkstream is not None:
-        sinkstream.write(line + "\n")
-        sinkstream.flush()
+        sinkstream.write(linebytes + b"\n")
 
     if not quiet and verbosepipe is not None:
-        print(label, line, file=verbosepipe)
-        verbosepipe.flush()
+        print(label, linebytes.decode('utf-8', 'replace'), file=verbosepipe)
 
 
 def patch_popen():
+    """
+    Replaces nox's popen with `patched_popen`. Calling this several times has no effect.
+    This is called lazily by `with_power_session` when the first session runs.
+    """
+    global orig_nox_popen
+
+    import nox.popen as nox_popen_module
+    if nox_popen_module.popen is patched_popen:
+        return
+
+    orig_nox_popen = nox_popen_module.popen
     nox_popen_module.popen = patched_popen
 
     from nox.command import popen
     if popen is not patched_popen:
         nox.command.popen = patched_popen
 
-    # change event loop on windows
-    # see https://stackoverflow.com/a/44639711/7262247
-    # and https://docs.python.org/3/library/asyncio-platforms.html#subprocess-support-on-windows
-    if 'win32' in sys.platform:
-        # Windows specific event-loop policy & cmd
-        asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
-        # cmds = [['C:/Windows/system32/HOSTNAME.EXE']]
-
-    # loop = asyncio.ProactorEventLoop()
-    # asyncio.set_event_loop(loop)
-
-
-patch_popen()
+    # create the event loop now, it will be reused by all commands
+    get_popen_event_loop()
@@ -1,6 +1,7 @@
 from itertools import product
 from json import dumps
 import logging
+import os
 
 import nox  # noqa
 from pathlib import Path  # noqa
@@ -32,8 +33,10 @@ ENVS = {
 # set the default activated sessions, minimal for CI
 nox.options.sessions = ["tests", "flake8"]  # , "docs", "gh_pages"
 nox.options.reuse_existing_virtualenvs = True  # this can be done using -r
+# conda envs are slow to create, so they are only used when USE_CONDA=1 (e.g. on CI, where the pythons come from conda)
 # if platform.system() == "Windows":  >> always use this for better control
-nox.options.default_venv_backend = "conda"
+USE_CONDA = os.environ.get("USE_CONDA") == "1"
+nox.options.default_venv_backend = "conda" if USE_CONDA else "virtualenv"
 # os.environ["NO_COLOR"] = "True"  # nox.options.nocolor = True does not work
 # nox.options.verbose = True
 
@@ -76,18 +79,27 @@ def tests(session: PowerSession, coverage, pkg_specs):
 
     # CI-only dependencies
     # Did we receive a flag through positional arguments ? (nox -s tests -- <flag>)
-    install_ci_deps = False
-    if len(session.posargs) == 1:
-        assert session.posargs[0] == "keyrings.alt"
-        install_ci_deps = True
-    elif len(session.posargs) > 1:
-        raise ValueError("Only a single positional argument is accepted, received: %r" % session.posargs)
+    # All other positional arguments are passed to pytest (nox -s tests -- -n 2)
+    pytest_args = list(session.posargs)
+    install_ci_deps = "keyrings.alt" in pytest_args
+    if install_ci_deps:
+        pytest_args.remove("keyrings.alt")
+
+    # run tests in parallel with pytest-xdist, unless the user already chose the number of workers. Tests sharing
+    # the keyring or cache are marked with the same xdist_group so that '--dist loadgroup' runs them on one worker.
+    # This requires pytest-xdist >= 2.5, not available on old pythons.
+    use_xdist = session.python not in (PY27, PY35)
+    if use_xdist and not any(a.startswith(("-n", "--numprocesses")) or a == "no:xdist" for a in pytest_args):
+        pytest_args = ["-n", "auto", "--dist", "loadgroup"] + pytest_args
+    pytest_args = " ".join(pytest_args)
 
     # uncomment and edit if you wish to uninstall something without deleting the whole env
     # session.run2("pip uninstall pytest-asyncio --yes")
 
     # install all requirements
     session.install_reqs(setup=True, install=True, tests=True, versions_dct=pkg_specs)
+    if use_xdist:
+        session.install_reqs(phase="xdist", phase_reqs=["pytest-xdist>=2.5"], versions_dct=pkg_specs)
 
     # install CI-only dependencies
     if install_ci_deps:
@@ -95,10 +107,14 @@ def tests(session: PowerSession, coverage, pkg_specs):
 
     # list all (conda list alone does not work correctly on github actions)
     # session.run2("conda list")
-    conda_prefix = Path(session.bin)
-    if conda_prefix.name == "bin":
-        conda_prefix = conda_prefix.parent
-    session.run2("conda list", env={"CONDA_PREFIX": str(conda_prefix), "CONDA_DEFAULT_ENV": session.get_session_id()})
+    if USE_CONDA:
+        conda_prefix = Path(session.bin)
+        if conda_prefix.name == "bin":
+            conda_prefix = conda_prefix.parent
+        session.run2("conda list",
+                     env={"CONDA_PREFIX": str(conda_prefix), "CONDA_DEFAULT_ENV": session.get_session_id()})
+    else:
+        session.run2("pip list")
 
     # Fail if the assumed python version is not the actual one
     session.run2("python ci_tools/check_python_version.py %s" % session.python)
@@ -114,17 +130,19 @@ def tests(session: PowerSession, coverage, pkg_specs):
     # finally run all tests
     if not coverage:
         # simple: pytest only
-        session.run2("python -m pytest --cache-clear -v %s/tests/" % pkg_name)
+        session.run2("python -m pytest --cache-clear %s -v %s/tests/" % (pytest_args, pkg_name))
     else:
         # coverage + junit html reports + badge generation
+        # note: pytest-cov is needed so that the coverage of the xdist workers is collected too
         session.install_reqs(phase="coverage",
-                             phase_reqs=["coverage", "pytest-html", "genbadge[tests,coverage]"],
+                             phase_reqs=["coverage", "pytest-cov", "pytest-html", "genbadge[tests,coverage]"],
                              versions_dct=pkg_specs)
 
         # --coverage + junit html reports
-        session.run2("coverage run --source {pkg_name} "
-                     "-m pytest --cache-clear --junitxml={test_xml} --html={test_html} -v {pkg_name}/tests/"
-                     "".format(pkg_name=pkg_name, test_xml=Folders.test_xml, test_html=Folders.test_html))
+        session.run2("python -m pytest --cov={pkg_name} --cov-report= --cache-clear --junitxml={test_xml} "
+                     "--html={test_html} {pytest_args} -v {pkg_name}/tests/"
+                     "".format(pkg_name=pkg_name, test_xml=Folders.test_xml, test_html=Folders.test_html,
+                               pytest_args=pytest_args))
         session.run2("coverage report")
         session.run2("coverage xml -o {covxml}".format(covxml=Folders.coverage_xml))
         session.run2("coverage html -d {dst}".format(dst=Folders.coverage_reports))
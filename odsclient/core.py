@@ -4,18 +4,56 @@
 #  License: 3-clause BSD, <https://github.com/smarie/python-odsclient/blob/master/LICENSE>
 import warnings
 from ast import literal_eval
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial, wraps
 from getpass import getpass
+import codecs
 import io
+import atexit
 import os
-from shutil import copyfile
-from threading import Lock
+from shutil import copyfile, copyfileobj
+from threading import Lock, Thread
+from uuid import uuid4
+from weakref import WeakValueDictionary
+
+try:
+    from functools import lru_cache
+except ImportError:
+    # python 2
+    def lru_cache(maxsize=128):
+        """A minimal `functools.lru_cache` for python 2, for functions with hashable positional arguments only"""
+        def decorator(f):
+            memo = OrderedDict()
+            lock = Lock()
+
+            @wraps(f)
+            def wrapper(*args):
+                with lock:
+                    try:
+                        result = memo.pop(args)
+                    except KeyError:
+                        result = f(*args)
+                    memo[args] = result  # most recently used last
+                    if len(memo) > maxsize:
+                        memo.popitem(last=False)
+                    return result
+            return wrapper
+        return decorator
 
 try:
     # Python 3
-    from urllib.parse import urlparse
+    from urllib.parse import urlparse, quote
 except ImportError:
     # Python 2
     from urlparse import urlparse
+    from urllib import quote as _quote
+
+    def quote(s, safe='/'):
+        """Same as `urllib.quote`, but encodes unicode strings to utf-8 first (as python 3 does) instead of failing"""
+        if isinstance(s, unicode):  # noqa
+            s = s.encode('utf-8')
+        return _quote(s, safe=safe)
 
 try:
     from pathlib import Path
@@ -34,23 +72,39 @@ else:
     from io import StringIO
     string_types = (str,)
 
+from json import dumps
 try:
-    from json import loads, JSONDecodeError, dumps
+    # optional, faster json parser and serializer (used on error payloads and realtime push bodies)
+    from orjson import loads as orjson_loads, dumps as orjson_dumps, OPT_NON_STR_KEYS
 except ImportError:
-    # python 2
-    from json import loads, dumps
-    JSONDecodeError = ValueError
+    orjson_loads = orjson_dumps = OPT_NON_STR_KEYS = None
+
 try:
     FileNotFoundError
 except NameError:
     # python 2
     FileNotFoundError = IOError
 
+try:
+    from os import replace as _replace_file
+except ImportError:
+    # python 2: os.rename can not overwrite an existing file on windows
+    def _replace_file(src, dst):
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
 from requests import Session, HTTPError
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    # old versions of requests
+    from requests.packages.urllib3.util.retry import Retry
 
 try:
     # noinspection PyUnresolvedReferences
-    from typing import Dict, Union, Iterable
+    from typing import Dict, Union, Iterable, Optional
 except ImportError:
     pass
 
@@ -59,6 +113,16 @@ CACHE_ENCODING = "utf-8"
 ODS_BASE_URL_TEMPLATE = "https://%s.opendatasoft.com"
 ENV_ODS_APIKEY = 'ODS_APIKEY'
 KR_DEFAULT_USERNAME = 'apikey_user'
+STREAM_CHUNK_SIZE = 64 * 1024     # size of the chunks read from the HTTP response when filling the cache
+STREAM_BUFFER_SIZE = 1024 * 1024  # default buffer size of `iterable_to_stream`
+SMALL_DATASET_MAX_SIZE = 16 * 1024 * 1024  # datasets smaller than this are read in one go by `get_whole_dataframe`
+CACHE_ENTRIES_MAXSIZE = 512  # maximum number of `CacheEntry` objects remembered by each client
+
+# the query parameters hardcoded in `get_whole_dataframe`, and the ones that can not be specified by users
+_DATAFRAME_OPTS = {'format': 'csv', 'csv_separator': ';'}
+_DATAFRAME_FORBIDDEN_OPTS = ('timezone', 'format', 'csv_separator')
+
+_UNSET = object()  # sentinel used for "not yet resolved" in caches where None is a valid value
 
 
 class ODSClient(object):
@@ -109,7 +173,8 @@ class ODSClient(object):
         Let's use this opportunity to close the requests Session to avoid
         leaving hanging Sockets, see https://github.com/smarie/python-odsclient/issues/27
         """
-        if self.auto_close_session and self.session is not None:
+        # note: use getattr since the constructor may have raised an error before setting the attributes
+        if getattr(self, 'auto_close_session', False) and self.session is not None:
             try:
                 # close the underlying `requests.Session`
                 self.session.close()
@@ -125,7 +190,11 @@ class ODSClient(object):
                  use_keyring=True,                              # type: bool
                  keyring_entries_username=KR_DEFAULT_USERNAME,  # type: str
                  requests_session=None,                         # type: Session
-                 auto_close_session=None                        # type: bool
+                 auto_close_session=None,                       # type: bool
+                 prewarm=False,                                 # type: bool
+                 cache_apikey=True,                             # type: bool
+                 pool_maxsize=None,                             # type: int
+                 max_retries=None                               # type: int
                  ):
         """
         Constructor for `ODSClient`s
@@ -145,11 +214,27 @@ class ODSClient(object):
             the base url for the service id, however the user name can be anything. By default we use a string:
             'apikey_user'.
         :param requests_session: an optional `Session` object to use (from `requests` lib). If `None` is provided,
-            a new `Session` will be used and deleted when this object is garbaged out. If a custom object is provided,
-            you should close it yourself or switch `auto_close_session` to `True` explicitly.
+            a new `Session` is created for this client, using the transport adapter shared by all clients so that they
+            share the same pool of open connections (see `get_default_adapter`). It is closed when the python process
+            exits. If a custom object is provided, you should close it yourself or switch `auto_close_session` to
+            `True` explicitly.
         :param auto_close_session: an optional boolean indicating if `self.session` should be closed when this object
-            is garbaged out. By default this is `None` and means "`True` if no custom `requests_session` is passed, else
-            `False`"). Turning this to `False` can leave hanging Sockets unclosed.
+            is garbaged out. By default this is `None` and means "`True` if a dedicated session was created for this
+            client (see `pool_maxsize` and `max_retries`), else `False`": the shared default adapter is closed at exit,
+            and custom sessions should be closed by their owner. Turning this to `False` with a custom session can
+            leave hanging Sockets unclosed.
+        :param prewarm: an optional boolean (default `False`) indicating if a connection to the server should be opened
+            in a background thread at construction time. This way the DNS resolution and TLS handshake are done before
+            the first query, that reuses the connection from the session pool. Errors are ignored.
+        :param cache_apikey: an optional boolean (default `True`) indicating if the api key found by `get_apikey()`
+            should be remembered, so that the keyring and environment variable are not looked up again at each query.
+            Use `invalidate_apikey_cache()` to force a new lookup, or set this to `False` to always look them up.
+        :param pool_maxsize: an optional maximum number of connections kept alive per host. If this or `max_retries`
+            is set, a dedicated session is created for this client with `create_default_session` instead of using the
+            shared default adapter. This is typically useful when many threads use the same client. Can not be used
+            together with `requests_session`.
+        :param max_retries: an optional maximum number of retries of a query on connection errors and transient HTTP
+            errors (429, 500, 502, 503, 504). See `pool_maxsize` for details.
         """
         # keyring option
         self.use_keyring = use_keyring
@@ -161,56 +246,114 @@ class ODSClient(object):
                 raise ValueError("Only one of `platform_id` and `base_url` should be provided. Received "
                                  "platform_id='%s' and base_url='%s'" % (platform_id, base_url))
             # remove trailing slashes
-            while base_url.endswith('/'):
-                base_url = base_url[:-1]
-            self.base_url = base_url
+            self.base_url = base_url.rstrip('/')
             self.platform_id = None
         else:
             self.platform_id = platform_id
             self.base_url = ODS_BASE_URL_TEMPLATE % platform_id
 
+        # keyring services to look for, in this order (see `get_apikey_from_keyring`)
+        self._keyring_url_variants = (self.base_url, self.base_url + '/')
+
+        # keys to look for, in this order, when the 'ODS_APIKEY' env variable is a dict (see `get_apikey_from_envvar`)
+        self._env_lookup_keys = tuple(k for k in (self.platform_id, self.base_url, 'default') if k is not None)
+
         # Load apikey from file and validate it
         self.apikey_filepath = apikey_filepath
         if apikey is not None:
             # api key passed as argument
             if apikey_filepath != 'ods.apikey':
                 raise ValueError("Only one of `apikey` and custom `apikey_filepath` should be provided.")
-            self.apikey = apikey
+            self.apikey = _validate_apikey(apikey, "the `apikey` argument")
 
         elif apikey_filepath is not None:
-            try:
-                # read the api key from the file
-                with open(str(apikey_filepath)) as f:
-                    self.apikey = f.read()
-            except FileNotFoundError:
-                self.apikey = None
+            # read the api key from the file if it exists (it usually does not: check first rather than catch an error)
+            apikey_file = Path(str(apikey_filepath))
+            if apikey_file.is_file():
+                # read the few bytes at once without the text layer (api keys are ascii), and remove trailing new
+                # lines or blanks if any
+                self.apikey = _validate_apikey(apikey_file.read_bytes().decode('utf-8'),
+                                               "file '%s'" % apikey_filepath)
             else:
-                # remove trailing new lines or blanks if any
-                self.apikey = self.apikey.rstrip()
+                self.apikey = None
         else:
             # no explicit api key. Environment variable will apply
             self.apikey = None
 
-        if self.apikey is not None and len(self.apikey) == 0:
-            raise ValueError('The provided api key is empty!')
-
         # checker flag
         self.enforce_apikey = enforce_apikey
 
-        # create and store a session
-        self.session = requests_session or Session()
+        # cache of the api key resolved by `get_apikey`
+        self.cache_apikey = cache_apikey
+        self._resolved_apikey = _UNSET
+
+        # base urls for datasets and realtime push, and cache of download urls per dataset id (see `get_download_url`)
+        self._datasets_url = self.base_url + "/explore/dataset/"
+        self._download_urls = dict()
+        self._push_api_url = self.base_url + "/api/push/1.0/"
+
+        # cache of authorization headers per api key (see `get_apikey_headers`)
+        self._apikey_headers = dict()
+
+        # name of the platform folder in the file cache, and LRU cache of the `CacheEntry` objects per
+        # (dataset_id, format, cache_root), most recently used last (see `get_cached_dataset_entry`)
+        if self.platform_id is not None:
+            self._platform_pseudo_id = self.platform_id
+        else:
+            self._platform_pseudo_id = baseurl_to_id_str(self.base_url)
+        self._cache_entries = OrderedDict()
+        self._cache_entries_lock = Lock()
+
+        # store the session, or create a dedicated one, or create one sharing the default connection pool
+        session_opts = dict()
+        if pool_maxsize is not None:
+            session_opts['pool_maxsize'] = pool_maxsize
+        if max_retries is not None:
+            session_opts['max_retries'] = max_retries
+        if requests_session is not None:
+            if len(session_opts) > 0:
+                raise ValueError("`pool_maxsize` and `max_retries` can not be used together with `requests_session`")
+            self.session = requests_session
+            self._pool_maxsize = None  # unknown
+        elif len(session_opts) > 0:
+            self.session = create_default_session(**session_opts)
+            self._pool_maxsize = session_opts.get('pool_maxsize', POOL_MAXSIZE)
+        else:
+            # note: the session (cookies, headers...) is specific to this client, only the connection pool is shared
+            self.session = Session()
+            adapter = get_default_adapter()
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+            self._pool_maxsize = DEFAULT_ADAPTER_POOL_MAXSIZE
+
         # auto-close behaviour
         if auto_close_session is None:
-            # default: only auto-close if this session was created by us.
-            auto_close_session = requests_session is None
+            # default: only auto-close a dedicated session created by us. Closing a session using the shared default
+            # adapter would close the connections of all other clients: the adapter is closed at exit instead (see
+            # `get_default_adapter`)
+            auto_close_session = len(session_opts) > 0
         self.auto_close_session = auto_close_session
 
+        # open a first connection in the background if needed
+        if prewarm:
+            t = Thread(target=self._prewarm_connection)
+            t.daemon = True
+            t.start()
+
+    def _prewarm_connection(self):
+        """Sends a cheap HEAD request to the base url, so that the connection is ready in the session pool."""
+        try:
+            self.session.head(self.base_url, timeout=2)
+        except Exception:
+            pass  # this is only an optimization: the actual queries will report errors
+
     def get_whole_dataframe(self,
                             dataset_id,                  # type: str
                             use_labels_for_header=True,  # type: bool
                             tqdm=False,                  # type: bool
                             block_size=1024,             # type: int
                             file_cache=False,            # type: bool
+                            csv_engine=None,             # type: str
                             **other_opts
                             ):
         """
@@ -219,9 +362,12 @@ class ODSClient(object):
         :param dataset_id:
         :param use_labels_for_header:
         :param tqdm: a boolean indicating if a progress bar using tqdm should be displayed. tqdm should be installed
-        :param block_size: an int block size used in streaming mode when tqdm is used
+        :param block_size: an int block size used as the progress bar unit when tqdm is used
         :param file_cache: a boolean (default False) indicating whether the file should be written to a local cache
             `.odsclient/<base_url>_<dataset_id>.<format>`. Or a path-like object with the custom cache root folder.
+        :param csv_engine: an optional parser engine to use in `pandas.read_csv`. For example `'pyarrow'` parses the
+            csv with several threads, which is much faster on large datasets (pyarrow should be installed). Note that
+            the column types inferred may differ from the ones of the default engine.
         :param other_opts:
         :return:
         """
@@ -230,23 +376,23 @@ class ODSClient(object):
         except ImportError as e:
             raise Exception("`get_whole_dataframe` requires `pandas` to be installed. [%s] %s" % (e.__class__, e))
 
-        # Combine all the options
+        if csv_engine is None:
+            read_csv = partial(pd.read_csv, sep=';')
+        else:
+            read_csv = partial(pd.read_csv, sep=';', engine=csv_engine)
+
+        # Combine all the options (note: `other_opts` is a new dict at each call, it can safely be modified)
         opts = other_opts
-        apikey = self.get_apikey()
-        if apikey is not None:
-            opts['apikey'] = apikey
+        headers = self.get_apikey_headers()
         if use_labels_for_header is not None:
             opts['use_labels_for_header'] = use_labels_for_header
 
         # hardcoded
-        if 'timezone' in opts:
-            raise ValueError("'timezone' should not be specified with this method")
-        if 'format' in opts:
-            raise ValueError("'format' should not be specified with this method")
-        opts['format'] = format = 'csv'
-        if 'csv_separator' in opts:
-            raise ValueError("'csv_separator' should not be specified with this method")
-        opts['csv_separator'] = ';'
+        for k in _DATAFRAME_FORBIDDEN_OPTS:
+            if k in opts:
+                raise ValueError("'%s' should not be specified with this method" % k)
+        opts.update(_DATAFRAME_OPTS)
+        format = 'csv'
 
         # Cache usage
         if file_cache:
@@ -258,7 +404,7 @@ class ODSClient(object):
                 # try to read the cached file in a thread-safe operation
                 with cached_file.rw_lock:
                     cached_file.assert_exists()
-                    df = pd.read_csv(str(cached_file.file_path), sep=';')
+                    df = read_csv(str(cached_file.file_path))
                     return df
             except CacheFileNotFoundError:
                 pass  # does not exist. continue to query
@@ -270,9 +416,10 @@ class ODSClient(object):
         url = self.get_download_url(dataset_id)
 
         # Execute call in stream mode with automatic content-type decoding
-        result = self._http_call(url, params=opts, stream=True, decode=True)
-        # print(iterable_to_stream(result.iter_content()).read())
+        result = self._http_call(url, headers=headers, params=opts, stream=True, decode=True)
         # noinspection PyTypeChecker
+        # the csv is utf-8 unless the server declares another charset
+        encoding = _get_declared_encoding(result)
 
         if tqdm:
             from tqdm import tqdm as _tqdm
@@ -284,25 +431,33 @@ class ODSClient(object):
                        unit_divisor=block_size
                        ) as bar:
                 if not cached_file:
-                    # Directly stream to memory with updates of the progress bar
-                    df = pd.read_csv(iterable_to_stream(result.iter_content(), buffer_size=block_size, progressbar=bar),
-                                     sep=';')
+                    # Directly stream to memory with updates of the progress bar. Note: the bar counts the bytes
+                    # received (see `_iter_content_with_progress`). `iterable_to_stream` returns a true binary buffered
+                    # reader, so that pandas decodes it with the right encoding whatever the `csv_engine`.
+                    stream = iterable_to_stream(_iter_content_with_progress(result, STREAM_CHUNK_SIZE, bar))
+                    df = read_csv(stream, encoding=encoding)
                 else:
                     # stream to cache file and read the dataframe from the cache (use the lock to make sure it is here)
                     with cached_file.rw_lock:
-                        cached_file.fill_from_iterable(result.iter_content(block_size), it_encoding=result.encoding,
-                                                       progress_bar=bar, lock=False)
-                        df = pd.read_csv(str(cached_file.file_path), sep=';')
+                        cached_file.fill_from_iterable(_iter_content_with_progress(result, STREAM_CHUNK_SIZE, bar),
+                                                       it_encoding=encoding, lock=False)
+                        df = read_csv(str(cached_file.file_path))
         else:
             if not cached_file:
-                # directly stream to memory dataframe
-                df = pd.read_csv(iterable_to_stream(result.iter_content(block_size)), sep=';')
+                content_length = int(result.headers.get('Content-Length', 0))
+                if 0 < content_length <= SMALL_DATASET_MAX_SIZE:
+                    # small dataset: reading the whole body at once is faster than streaming it
+                    df = read_csv(io.BytesIO(result.content), encoding=encoding)
+                else:
+                    # directly stream to memory dataframe. `result.raw` is already a buffered file-like object, with
+                    # automatic content decoding (see `_http_call`): no need for an intermediate `iterable_to_stream`.
+                    df = read_csv(result.raw, encoding=encoding)
             else:
                 # stream to cache file and read the dataframe from the cache (use the lock to make sure it is here)
                 with cached_file.rw_lock:
-                    cached_file.fill_from_iterable(result.iter_content(block_size), it_encoding=result.encoding,
+                    cached_file.fill_from_iterable(result.iter_content(STREAM_CHUNK_SIZE), it_encoding=encoding,
                                                    lock=False)
-                    df = pd.read_csv(str(cached_file.file_path), sep=';')
+                    df = read_csv(str(cached_file.file_path))
 
         return df
 
@@ -317,10 +472,11 @@ class ODSClient(object):
                           to_path=None,                # type: Union[str, Path]
                           file_cache=False,            # type: bool
                           block_size=1024,             # type: int
+                          as_stream=False,             # type: bool
                           **other_opts
                           ):
         """
-        Returns a dataset as a csv string.
+        Returns a dataset as a csv string, or as a binary file-like object if `as_stream=True`.
 
         :param dataset_id:
         :param format:
@@ -331,10 +487,17 @@ class ODSClient(object):
         :param to_path: a string indicating the file path where to write the csv. In that case None is returned
         :param file_cache: a boolean (default False) indicating whether the file should be written to a local cache
             `.odsclient/<base_url>_<dataset_id>.<format>`. Or a path-like object with the custom cache root folder.
-        :param block_size: an int block size used in streaming mode when to_csv or tqdm is used
+        :param block_size: an int block size used as the progress bar unit when tqdm is used. In streaming mode
+            (when to_path or tqdm is used), the contents are read by chunks of `block_size` bytes or 64KiB if larger.
+        :param as_stream: a boolean (default False) indicating that instead of a string, the binary file-like object
+            `response.raw` should be returned, so that the caller can consume it directly (for example with
+            `pandas.read_csv` or `io.TextIOWrapper`) without building an intermediate string. Its contents are the
+            (decompressed) bytes received. This can not be used with `tqdm`, `to_path` or `file_cache`.
         :param other_opts:
         :return:
         """
+        if as_stream and (tqdm or to_path is not None or file_cache):
+            raise ValueError("`as_stream=True` can not be used together with `tqdm`, `to_path` or `file_cache`")
 
         # ------- To uncomment one day if headers and/or body are needed
         # headers = {'Authorization': ('Bearer ' + api_key)}
@@ -348,11 +511,9 @@ class ODSClient(object):
         #     json_body_encoded_with_charset = None
         # ------------------
 
-        # Combine all the options
+        # Combine all the options (note: `other_opts` is a new dict at each call, it can safely be modified)
         opts = other_opts
-        apikey = self.get_apikey()
-        if apikey is not None:
-            opts['apikey'] = apikey
+        headers = self.get_apikey_headers()
         if format is not None:
             opts['format'] = format
         if timezone is not None:
@@ -394,26 +555,38 @@ class ODSClient(object):
 
         # Execute call, since no cache was used
         result = None
-        if not tqdm:
+        chunk_size = max(block_size, STREAM_CHUNK_SIZE)  # small chunks would mean many python-level iterations
+        if as_stream:
+            # Let the caller consume the stream, with automatic content decoding (gzip...)
+            result = self._http_call(url, headers=headers, params=opts, stream=True, decode=True).raw
+        elif not tqdm:
             if to_path is None:
-                # We need to return a csv string, so load everything in memory
-                result, content_type = self._http_call(url, params=opts, stream=False, decode=True)
-
-                if cached_file:  # cache it in local cache if needed
-                    cached_file.fill_from_str(txt_initial_encoding=content_type, decoded_txt=result)
+                if cached_file:
+                    # stream to the cache file and read the csv string from it: this way the whole contents are never
+                    # in memory both as bytes and as a string (use the lock to make sure that the file is ours)
+                    r = self._http_call(url, headers=headers, params=opts, stream=True, decode=True)
+                    with cached_file.rw_lock:
+                        cached_file.fill_from_iterable(r.iter_content(chunk_size),
+                                                       it_encoding=_get_declared_encoding(r), lock=False)
+                        result = cached_file.read(lock=False)
+                else:
+                    # We need to return a csv string, so load everything in memory
+                    result, _ = self._http_call(url, headers=headers, params=opts, stream=False, decode=True)
             else:
-                # No need to return a csv string: stream directly to csv file (no decoding/encoding)
-                r = self._http_call(url, params=opts, stream=True, decode=False)
-                with open(str(to_path), mode='wb') as f:
-                    for data in r.iter_content(block_size):
-                        f.write(data)
+                # No need to return a csv string: stream directly to csv file (no decoding/encoding). Note: the
+                # content decoding (gzip...) is still needed, it is done by `r.raw` since `decode=True`.
+                # The file is replaced only once the download is complete.
+                r = self._http_call(url, headers=headers, params=opts, stream=True, decode=True)
+                with _tmp_file_replacing(str(to_path)) as tmp_path, open(tmp_path, mode='wb') as f:
+                    copyfileobj(r.raw, f, chunk_size)
 
                 if cached_file:  # cache it in local cache if needed
-                    cached_file.fill_from_file(file_path=to_path, file_encoding=r.encoding)
+                    cached_file.fill_from_file(file_path=to_path, file_encoding=_get_declared_encoding(r))
         else:
             # Progress bar is needed: we need streaming mode
-            r = self._http_call(url, params=opts, stream=True, decode=False)
+            r = self._http_call(url, headers=headers, params=opts, stream=True, decode=False)
             total_size = int(r.headers.get('Content-Length', 0))
+            encoding = _get_declared_encoding(r)
 
             from tqdm import tqdm as _tqdm
             with _tqdm(desc=url, total=total_size,
@@ -422,28 +595,143 @@ class ODSClient(object):
                        unit_divisor=block_size
                        ) as bar:
                 if to_path is None:
-                    result = io.StringIO()                     # stream to a string in memory
-                    for data in r.iter_content(block_size):    # block by block
-                        bar.update(len(data))                  # - update progress bar
-                        result.write(data.decode(r.encoding))  # - decode with proper encoding
-                    result = result.getvalue()
+                    # stream to a string in memory. Note: an incremental decoder is needed since a multi-byte
+                    # character may be split across two blocks
+                    decoder = codecs.getincrementaldecoder(encoding)()
+                    parts = []
+                    for data in _iter_content_with_progress(r, chunk_size, bar):  # block by block, updating bar
+                        parts.append(decoder.decode(data))                       # - decode with proper encoding
+                    parts.append(decoder.decode(b'', final=True))
+                    result = ''.join(parts)
 
                     if cached_file:                            # cache it in local cache if needed
-                        cached_file.fill_from_str(txt_initial_encoding=r.encoding, decoded_txt=result)
+                        cached_file.fill_from_str(txt_initial_encoding=encoding, decoded_txt=result)
                 else:
-                    with open(str(to_path), 'wb') as f:          # stream to csv file in binary mode
-                        for data in r.iter_content(block_size):  # block by block
-                            bar.update(len(data))                # - update progress bar
-                            f.write(data)                        # - direct copy (no decoding/encoding)
+                    # stream to csv file in binary mode (direct copy, no decoding/encoding). The file is replaced
+                    # only once the download is complete.
+                    with _tmp_file_replacing(str(to_path)) as tmp_path, open(tmp_path, 'wb') as f:
+                        for data in _iter_content_with_progress(r, chunk_size, bar):  # block by block, updating bar
+                            f.write(data)
 
                     if cached_file:                              # cache it in local cache if needed
-                        cached_file.fill_from_file(file_path=to_path, file_encoding=r.encoding)
+                        cached_file.fill_from_file(file_path=to_path, file_encoding=encoding)
 
             if total_size != 0 and bar.n != total_size:
                 raise ValueError("ERROR, something went wrong")
 
         return result
 
+    def get_whole_dataset_bytes(self, dataset_id, **kwargs):
+        # type: (...) -> bytes
+        """
+        Same as `get_whole_dataset`, but returns the dataset as the bytes received from the server (decompressed if
+        needed) instead of a string. This avoids decoding the whole contents into a string when it is not needed,
+        for example to forward them to another system, or to a parser able to read bytes.
+
+        Note that the bytes are encoded using the charset sent by the server (typically utf-8).
+
+        :param dataset_id:
+        :param kwargs: the arguments of `get_whole_dataset`, except `tqdm`, `to_path`, `file_cache` and `as_stream`.
+        :return: the dataset contents as bytes
+        """
+        raw = self.get_whole_dataset(dataset_id, as_stream=True, **kwargs)
+        try:
+            return raw.read()
+        finally:
+            # make the connection available again in the pool
+            raw.release_conn()
+
+    def download_dataset_to_file(self,
+                                 dataset_id,              # type: str
+                                 path,                    # type: Union[str, Path]
+                                 chunk_size=1024 * 1024,  # type: int
+                                 **kwargs
+                                 ):
+        """
+        Downloads a dataset to file `path` in streaming mode: the contents are written to the file by chunks of
+        `chunk_size` bytes, so the whole dataset is never loaded in memory. The bytes received are written as is
+        (decompressed if needed), without decoding/encoding. They are written to a temporary file that replaces `path`
+        only once the download is complete: an interrupted download does not leave a truncated file behind.
+
+        This is equivalent to `get_whole_dataset(dataset_id, to_path=path, block_size=chunk_size, **kwargs)`, with a
+        default chunk size better suited to large files.
+
+        :param dataset_id:
+        :param path: the file path where to write the dataset. Parent folders are created if needed.
+        :param chunk_size: the size of the chunks written to the file. Default is 1MiB.
+        :param kwargs: the arguments of `get_whole_dataset`, except `to_path`, `block_size` and `as_stream`.
+        :return: None
+        """
+        for k in ('to_path', 'block_size', 'as_stream'):
+            if k in kwargs:
+                raise ValueError("'%s' should not be specified with this method" % k)
+        return self.get_whole_dataset(dataset_id, to_path=path, block_size=chunk_size, **kwargs)
+
+    def aget_whole_dataset(self, dataset_id, **kwargs):
+        """
+        Asynchronous version of `get_whole_dataset`, accepting the same arguments. It returns an `asyncio` awaitable,
+        so that several datasets can be downloaded concurrently from within a running event loop:
+
+        >>> csvs = await asyncio.gather(*[client.aget_whole_dataset(d) for d in dataset_ids])
+
+        The query is executed by `get_whole_dataset` in the default executor of the running event loop, so it reuses
+        the pooled connections of `self.session`. Requires python 3.
+
+        :param dataset_id:
+        :param kwargs: the arguments of `get_whole_dataset`
+        :return: an awaitable returning the result of `get_whole_dataset`
+        """
+        return _run_in_executor(partial(self.get_whole_dataset, dataset_id, **kwargs))
+
+    def aget_whole_dataframe(self, dataset_id, **kwargs):
+        """
+        Asynchronous version of `get_whole_dataframe`, accepting the same arguments. See `aget_whole_dataset`.
+
+        :param dataset_id:
+        :param kwargs: the arguments of `get_whole_dataframe`
+        :return: an awaitable returning the result of `get_whole_dataframe`
+        """
+        return _run_in_executor(partial(self.get_whole_dataframe, dataset_id, **kwargs))
+
+    def get_many_datasets(self,
+                          dataset_ids,   # type: Iterable[str]
+                          max_workers=8,  # type: int
+                          **kwargs
+                          ):
+        # type: (...) -> Dict[str, Union[str, Exception]]
+        """
+        Downloads several datasets concurrently using a pool of `max_workers` threads, all sharing `self.session`.
+        Each dataset is retrieved with `get_whole_dataset(dataset_id, **kwargs)`.
+
+        Errors do not stop the other downloads: the exception raised for a dataset is returned in place of its
+        contents.
+
+        :param dataset_ids: an iterable of dataset ids
+        :param max_workers: the maximum number of concurrent downloads. It should not be greater than the size of the
+            session's connection pool, otherwise connections will be discarded after use (see `pool_maxsize`).
+        :param kwargs: the arguments of `get_whole_dataset`, except `to_path`.
+        :return: a dictionary {dataset_id: csv string or exception}
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if 'to_path' in kwargs:
+            raise ValueError("'to_path' should not be specified with this method")
+
+        if self._pool_maxsize is not None and self._pool_maxsize < max_workers:
+            warnings.warn("`max_workers` (%s) is greater than the session's connection pool size (%s): connections "
+                          "will not all be reused. Use the `pool_maxsize` option of `ODSClient` to fix this."
+                          % (max_workers, self._pool_maxsize))
+
+        dataset_ids = list(dataset_ids)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.get_whole_dataset, dataset_id, **kwargs) for dataset_id in dataset_ids]
+
+        results = dict()
+        for dataset_id, future in zip(dataset_ids, futures):
+            error = future.exception()
+            results[dataset_id] = error if error is not None else future.result()
+        return results
+
     # noinspection PyShadowingBuiltins
     def push_dataset_realtime(self,
                               dataset_id,         # type: str
@@ -486,8 +774,10 @@ class ODSClient(object):
                                 % (e.__class__, e))
             # noinspection PyStatementEffect
             dataset  # type:str
-            csv_reader = csv.DictReader(StringIO(dataset), delimiter=csv_separator)
-            request_body = dumps([r for r in csv_reader])
+            rows = _csv_to_records(csv.reader(StringIO(dataset), delimiter=csv_separator))
+            # note: orjson directly serializes to utf-8 bytes, stdlib json to an ascii-only str. Both can be sent.
+            # Rows longer than the header have their extra fields under the `None` key, that stdlib json writes "null"
+            request_body = orjson_dumps(rows, option=OPT_NON_STR_KEYS) if orjson_dumps is not None else dumps(rows)
         else:
             raise ValueError("Dataset format must be either `pandas` or `csv`")
 
@@ -513,14 +803,16 @@ class ODSClient(object):
             api key
         :return:
         """
-        import keyring
+        keyring = _get_keyring()
         if apikey is None:
             apikey = getpass(prompt="Please enter your api key: ")
 
-        if apikey is None or len(apikey) == 0:
+        if apikey is None:
             raise ValueError("Empty api key provided.")
+        apikey = _validate_apikey(apikey, "the provided api key")
 
         keyring.set_password(self.base_url, self.keyring_entries_username, apikey)
+        self.invalidate_apikey_cache()
 
     def remove_apikey_from_keyring(self):
         """
@@ -528,8 +820,9 @@ class ODSClient(object):
 
         :return:
         """
-        import keyring
+        keyring = _get_keyring()
         keyring.delete_password(self.base_url, self.keyring_entries_username)
+        self.invalidate_apikey_cache()
 
     def get_apikey_from_keyring(self, ignore_import_errors=False):
         """
@@ -542,7 +835,7 @@ class ODSClient(object):
         """
         if ignore_import_errors:
             try:
-                import keyring
+                keyring = _get_keyring()
             except ImportError as e:
                 # not installed: simply warn instead of raising exception
                 warnings.warn("`keyring` is not installed but the `ODSClient` is configured to use it. You can either"
@@ -551,10 +844,12 @@ class ODSClient(object):
                 return None
         else:
             # do not catch any exception
-            import keyring
+            keyring = _get_keyring()
 
-        for _url in (self.base_url, self.base_url + '/'):
+        for _url in self._keyring_url_variants:
             apikey = keyring.get_password(_url, self.keyring_entries_username)
+            # note: an empty entry is ignored, as if there was no entry
+            apikey = _normalize_apikey(apikey)
             if apikey is not None:
                 return apikey
 
@@ -578,45 +873,45 @@ class ODSClient(object):
             # no env var - return None
             return None
 
-        if len(env_api_key) > 0 and env_api_key[0] == '{':
-            # a dictionary: use ast.literal_eval: more permissive than json and as safe.
-            apikeys_dct = literal_eval(env_api_key)
-            if not isinstance(apikeys_dct, dict):
-                raise TypeError("Environment variable contains something that is neither a str not a dict")
-
-            # remove trailing slash in keys
-            def _remove_trailing_slash(k):
-                while k.endswith('/'):
-                    k = k[:-1]
-                return k
-
-            apikeys_dct = {_remove_trailing_slash(k): v for k, v in apikeys_dct.items()}
+        if env_api_key.startswith('{'):
+            # a dictionary
+            apikeys_dct = _parse_env_apikeys(env_api_key)
 
             # Try to get a match in the dict: first platform id, then base url, then default
-            if self.platform_id in apikeys_dct:
-                env_api_key = apikeys_dct[self.platform_id]
-            elif self.base_url in apikeys_dct:
-                env_api_key = apikeys_dct[self.base_url]
-            elif 'default' in apikeys_dct:
-                env_api_key = apikeys_dct['default']
+            for k in self._env_lookup_keys:
+                if k in apikeys_dct:
+                    env_api_key = apikeys_dct[k]
+                    break
             else:
                 return None
 
-        if len(env_api_key) == 0:
-            raise ValueError("Empty api key found in '%s' environment variable." % ENV_ODS_APIKEY)
-
-        return env_api_key
+        return _validate_apikey(env_api_key, "'%s' environment variable" % ENV_ODS_APIKEY)
 
     def get_apikey(self):
         """
         Returns the api key that this client currently uses.
 
+        If `cache_apikey` is True (default), the result of the first lookup is remembered. See
+        `invalidate_apikey_cache()`.
+
         :return:
         """
         # 1- if there is an overridden api key, use it
         if self.apikey is not None:
             return self.apikey
 
+        # use the cached result if any
+        if self._resolved_apikey is not _UNSET:
+            return self._resolved_apikey
+
+        apikey = self._lookup_apikey()
+        if self.cache_apikey:
+            self._resolved_apikey = apikey
+        return apikey
+
+    def _lookup_apikey(self):
+        """Looks up the api key in keyring and in environment variables (steps 2 to 4 of `get_apikey`)"""
+
         # 2- if keyring service is installed and contains an entry, use it
         if self.use_keyring:
             apikey = self.get_apikey_from_keyring(ignore_import_errors=True)
@@ -632,6 +927,32 @@ class ODSClient(object):
         if self.enforce_apikey:
             raise NoODSAPIKeyFoundError(self)
 
+    def invalidate_apikey_cache(self):
+        """
+        Forgets the api key remembered by `get_apikey()` (if `cache_apikey` is True), so that the keyring and
+        environment variable are looked up again at next query.
+
+        :return:
+        """
+        self._resolved_apikey = _UNSET
+
+    def get_apikey_headers(self):
+        """
+        Returns the HTTP headers to use to authenticate with the api key that this client currently uses (see
+        `get_apikey`), or None if there is no api key. The api key is sent in an `Authorization: Apikey <key>` header
+        rather than in the query parameters, so that it is not percent-encoded at each call nor visible in urls.
+
+        :return:
+        """
+        apikey = self.get_apikey()
+        if apikey is None:
+            return None
+        try:
+            return self._apikey_headers[apikey]
+        except KeyError:
+            headers = self._apikey_headers[apikey] = {'Authorization': 'Apikey ' + apikey}
+            return headers
+
     def get_download_url(self,
                          dataset_id  # type: str
                          ):
@@ -641,7 +962,12 @@ class ODSClient(object):
         :param dataset_id:
         :return:
         """
-        return "%s/explore/dataset/%s/download/" % (self.base_url, dataset_id)
+        try:
+            return self._download_urls[dataset_id]
+        except KeyError:
+            # percent-encode the dataset id once here, rather than letting requests re-quote the url at each call
+            url = self._download_urls[dataset_id] = self._datasets_url + quote(dataset_id, safe='') + "/download/"
+            return url
 
     def get_cached_dataset_entry(self,
                                  dataset_id,       # type: str
@@ -650,17 +976,27 @@ class ODSClient(object):
                                  ):
         # type: (...) -> CacheEntry
         """
-        Returns a `CacheEntry` for the given dataset
+        Returns a `CacheEntry` for the given dataset. The last `CACHE_ENTRIES_MAXSIZE` entries used are remembered by
+        this client, so that the same object is returned for the same arguments. Note that all entries for the same
+        file share the same lock anyway, even if they are different objects.
+
         :param dataset_id:
         :param format:
         :param cache_root:
         :return:
         """
-        if self.platform_id is not None:
-            p = self.platform_id
-        else:
-            p = baseurl_to_id_str(self.base_url)
-        return CacheEntry(dataset_id=dataset_id, dataset_format=format, platform_pseudo_id=p, cache_root=cache_root)
+        key = (dataset_id, format, cache_root)
+        with self._cache_entries_lock:
+            try:
+                entry = self._cache_entries.pop(key)
+            except KeyError:
+                entry = CacheEntry(dataset_id=dataset_id, dataset_format=format,
+                                   platform_pseudo_id=self._platform_pseudo_id, cache_root=cache_root)
+                if len(self._cache_entries) >= CACHE_ENTRIES_MAXSIZE:
+                    # forget the least recently used entry
+                    self._cache_entries.popitem(last=False)
+            self._cache_entries[key] = entry  # most recently used last
+            return entry
 
     def get_realtime_push_url(self,
                               dataset_id,  # type: str
@@ -671,7 +1007,7 @@ class ODSClient(object):
         :param dataset_id:
         :return:
         """
-        return "%s/api/push/1.0/%s/realtime/push/" % (self.base_url, dataset_id)
+        return self._push_api_url + quote(dataset_id, safe='') + "/realtime/push/"
 
     def _http_call(self,
                    url,           # type: str
@@ -700,19 +1036,27 @@ class ODSClient(object):
             # Send the request (DO NOT encode the params, this is done automatically)
             response = self.session.request(method, url, headers=headers, data=body, params=params, stream=stream)
 
-            # Success ? Read status code, raise an HTTPError if status is error
-            # status = int(response.status_code)
-            response.raise_for_status()
+            # Success ? Read status code, raise an HTTPError if status is error. Note: `raise_for_status` builds the
+            # reason string in all cases, so only call it when needed
+            if response.status_code >= 400:
+                response.raise_for_status()
 
-            # detect a "wrong 200 but true 401" (unauthorized)
-            if 'html' in response.headers['Content-Type']:
+            # detect a "wrong 200 but true 401" (unauthorized): the login page is sent as 'text/html'
+            if response.headers.get('Content-Type', '').startswith('text/html'):
                 raise InsufficientRightsForODSResourceError(response.headers, response.text)
 
             if not stream:
                 if decode:
-                    # Contents (encoding is automatically used to read the body when calling response.text)
-                    result = response.text
-                    return result, response.encoding
+                    # Contents. Note: we do not use response.text, that would guess the encoding from the whole
+                    # contents with a costly charset detection when the server sends no charset: assume utf-8
+                    encoding = _get_declared_encoding(response)
+                    try:
+                        result = response.content.decode(encoding, 'replace')
+                    except LookupError:
+                        # unknown encoding
+                        encoding = 'utf-8'
+                        result = response.content.decode(encoding, 'replace')
+                    return result, encoding
                 else:
                     return response
             else:
@@ -721,7 +1065,6 @@ class ODSClient(object):
 
         except HTTPError as error:
             try:
-                body = error.response.text
                 # {
                 #   "errorcode": 10002,
                 #   "reset_time": "2017-10-17T00:00:00Z",
@@ -729,9 +1072,13 @@ class ODSClient(object):
                 #   "call_limit": 10000,
                 #   "error": "Too many requests on the domain. Please contact the domain administrator."
                 # }
-                details = loads(body)
-            except JSONDecodeError:
-                # error parsing the json payload?
+                # note: both decode the body bytes directly, without building the `.text` string first
+                if orjson_loads is not None:
+                    details = orjson_loads(error.response.content)
+                else:
+                    details = error.response.json()
+            except ValueError:
+                # error parsing the json payload? (all json decoding errors are ValueErrors, including orjson's)
                 pass
             else:
                 raise ODSException(error.response.status_code, error.response.headers, **details)
@@ -739,6 +1086,83 @@ class ODSClient(object):
             raise error
 
 
+def _normalize_apikey(apikey  # type: Optional[str]
+                      ):
+    # type: (...) -> Optional[str]
+    """
+    Removes the leading and trailing blanks and new lines of `apikey`. Returns None if `apikey` is None or if nothing
+    is left.
+
+    :param apikey: the api key, or None
+    :return:
+    """
+    if apikey is None:
+        return None
+    apikey = apikey.strip()
+    return apikey if len(apikey) > 0 else None
+
+
+def _validate_apikey(apikey,  # type: Optional[str]
+                     origin   # type: str
+                     ):
+    # type: (...) -> Optional[str]
+    """
+    Same as `_normalize_apikey`, but raises a ValueError if `apikey` is not None and is empty once normalized.
+
+    :param apikey: the api key, or None
+    :param origin: a description of where the api key comes from, used in the error message
+    :return:
+    """
+    normalized = _normalize_apikey(apikey)
+    if normalized is None and apikey is not None:
+        raise ValueError("Empty api key found in %s." % origin)
+    return normalized
+
+
+_keyring = None  # the keyring module, imported at first use by `_get_keyring`
+
+
+def _get_keyring():
+    """
+    Returns the `keyring` module, imported the first time it is needed so that importing odsclient stays fast.
+    Raises an ImportError if it is not installed.
+    """
+    global _keyring
+    if _keyring is None:
+        import keyring
+        _keyring = keyring
+    return _keyring
+
+
+_LAST_PARSED_ENV_APIKEYS = (None, None)  # the last (string, dict) parsed by `_parse_env_apikeys`
+
+
+def _parse_env_apikeys(env_api_key  # type: str
+                       ):
+    # type: (...) -> Dict[str, str]
+    """
+    Parses the dict-like contents of the 'ODS_APIKEY' environment variable, and removes the trailing slashes in keys.
+
+    The result for the last string parsed is remembered, since the variable usually does not change between queries.
+    The returned dict should therefore not be modified.
+    """
+    global _LAST_PARSED_ENV_APIKEYS
+    last_str, last_dct = _LAST_PARSED_ENV_APIKEYS
+    if env_api_key == last_str:
+        return last_dct
+
+    # use ast.literal_eval: more permissive than json and as safe.
+    apikeys_dct = literal_eval(env_api_key)
+    if not isinstance(apikeys_dct, dict):
+        raise TypeError("Environment variable contains something that is neither a str not a dict")
+
+    # remove trailing slashes in keys
+    apikeys_dct = {k.rstrip('/'): v for k, v in apikeys_dct.items()}
+
+    _LAST_PARSED_ENV_APIKEYS = (env_api_key, apikeys_dct)
+    return apikeys_dct
+
+
 class NoODSAPIKeyFoundError(Exception):
     """
     Raised when no api key was found (no explicit api key provided, no api key file, no env variable entry, no keyring
@@ -802,6 +1226,83 @@ class ODSException(Exception):
                                                                       self.details, self.headers)
 
 
+POOL_MAXSIZE = 16  # default maximum number of connections kept alive per host, see `create_default_session`
+
+
+def create_default_session(pool_connections=4,             # type: int
+                           pool_maxsize=POOL_MAXSIZE,      # type: int
+                           max_retries=3,                  # type: int
+                           backoff_factor=0.3              # type: float
+                           ):
+    # type: (...) -> Session
+    """
+    Creates a `requests.Session` for `ODSClient`s, using a new transport adapter created with `create_default_adapter`.
+
+    :param pool_connections: the number of hosts for which a connection pool is kept
+    :param pool_maxsize: the maximum number of connections kept alive in each pool
+    :param max_retries: the maximum number of retries of a query
+    :param backoff_factor: the backoff factor applied between retries, see `urllib3.util.retry.Retry`
+    :return: a requests.Session object
+    """
+    adapter = create_default_adapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                     max_retries=max_retries, backoff_factor=backoff_factor)
+    s = Session()
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    return s
+
+
+def create_default_adapter(pool_connections=4,             # type: int
+                           pool_maxsize=POOL_MAXSIZE,      # type: int
+                           max_retries=3,                  # type: int
+                           backoff_factor=0.3              # type: float
+                           ):
+    # type: (...) -> HTTPAdapter
+    """
+    Creates the `requests` transport adapter used by `ODSClient`s. It keeps a pool of connections alive (to avoid new
+    TCP+TLS handshakes between successive queries), and retries idempotent queries on connection errors and transient
+    HTTP errors (429, 500, 502, 503, 504).
+
+    :param pool_connections: the number of hosts for which a connection pool is kept
+    :param pool_maxsize: the maximum number of connections kept alive in each pool
+    :param max_retries: the maximum number of retries of a query
+    :param backoff_factor: the backoff factor applied between retries, see `urllib3.util.retry.Retry`
+    :return: a requests.adapters.HTTPAdapter object
+    """
+    # when the retries are exhausted on an error status, the last response should be returned and not raise an
+    # error, so that the error details sent by ODS can be parsed (see `ODSClient._http_call`)
+    retry = Retry(total=max_retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+                  raise_on_status=False)
+    return HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+
+
+_DEFAULT_ADAPTER = None
+_DEFAULT_ADAPTER_LOCK = Lock()
+DEFAULT_ADAPTER_POOL_MAXSIZE = 50  # maximum number of connections kept alive per host by the shared default adapter
+
+
+def get_default_adapter():
+    # type: (...) -> HTTPAdapter
+    """
+    Returns the `requests` transport adapter shared by all `ODSClient`s created without custom `requests_session`. It
+    is created with `create_default_adapter` at first call, and closed when the python process exits.
+
+    Each client has its own `requests.Session`, so that cookies, headers and authentication are never shared between
+    clients. Sharing the adapter allows all of them (and all shortcut functions such as `get_whole_dataset`) to reuse
+    the same pool of open connections, instead of performing new TCP+TLS handshakes.
+
+    :return: the shared requests.adapters.HTTPAdapter object
+    """
+    global _DEFAULT_ADAPTER
+    if _DEFAULT_ADAPTER is None:
+        with _DEFAULT_ADAPTER_LOCK:
+            if _DEFAULT_ADAPTER is None:
+                adapter = create_default_adapter(pool_connections=10, pool_maxsize=DEFAULT_ADAPTER_POOL_MAXSIZE)
+                atexit.register(adapter.close)
+                _DEFAULT_ADAPTER = adapter
+    return _DEFAULT_ADAPTER
+
+
 def create_session_for_fiddler():
     # type: (...) -> Session
     return create_session_for_proxy(http_proxyhost='localhost', http_proxyport=8888,
@@ -852,51 +1353,184 @@ def create_session_for_proxy(http_proxyhost,                  # type: str
     return s
 
 
-def iterable_to_stream(iterable, buffer_size=io.DEFAULT_BUFFER_SIZE, progressbar=None):
+def _get_declared_encoding(response):
+    """
+    Returns the encoding declared by the charset of the 'Content-Type' header of `response`, or 'utf-8' if there is
+    none. Note: `response.encoding` can not be used for this, since requests defaults to ISO-8859-1 for all text/* types
+    """
+    for param in response.headers.get('Content-Type', '').split(';')[1:]:
+        key, _, value = param.partition('=')
+        if key.strip().lower() == 'charset':
+            return value.strip(' \'"') or 'utf-8'
+    return 'utf-8'
+
+
+def _iter_content_with_progress(response, block_size, progressbar):
+    """
+    Same as `response.iter_content(block_size)`, but also updates `progressbar` with the number of bytes received so
+    far. When the contents are compressed (e.g. gzip), this is less than the size of the decoded blocks yielded, but
+    this is consistent with the 'Content-Length' header used as the progress bar total.
+    """
+    raw = response.raw
+    for data in response.iter_content(block_size):
+        progressbar.update(raw.tell() - progressbar.n)
+        yield data
+
+
+def _csv_to_records(csv_reader):
+    """
+    Returns the list of dicts that `csv.DictReader` would yield from the rows of `csv_reader`: the first row is the
+    header, empty rows are skipped, missing values are `None` and extra values are listed under the `None` key. It is
+    faster than iterating on `csv.DictReader`, whose pure-python `__next__` is called for every row.
+    """
+    try:
+        header = next(csv_reader)
+    except StopIteration:
+        return []
+
+    n = len(header)
+    records = []
+    for row in csv_reader:
+        if not row:
+            continue  # empty rows are skipped
+        d = dict(zip(header, row))
+        if len(row) != n:
+            if n < len(row):
+                d[None] = row[n:]
+            else:
+                for key in header[len(row):]:
+                    d[key] = None
+        records.append(d)
+    return records
+
+
+def _run_in_executor(f):
+    """
+    Executes `f()` in the default executor of the running asyncio event loop, and returns the corresponding future.
+    Note: we do not use the `async def` syntax so that this module can still be imported in python 2.
+    """
+    import asyncio
+    get_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)  # get_running_loop is python 3.7+
+    return get_loop().run_in_executor(None, f)
+
+
+def iterable_to_stream(iterable, buffer_size=STREAM_BUFFER_SIZE, progressbar=None):
     """
     Lets you use an iterable (e.g. a generator) that yields bytestrings as a read-only
     input stream.
 
     The stream implements Python 3's newer I/O API (available in Python 2's io module).
-    For efficiency, the stream is buffered.
+    For efficiency, the stream is buffered, with a large default `buffer_size` (1MiB) so that the number of python-level
+    `readinto` calls stays low on big datasets.
 
     Source: https://stackoverflow.com/a/20260030/7262247
     """
 
     class IterStream(io.RawIOBase):
         def __init__(self):
+            # a zero-copy view on the current chunk, and the position of the first byte not yet read in it
             self.leftover = None
+            self.pos = 0
 
         def readable(self):
             return True
 
         def readinto(self, b):
             try:
-                ln = len(b)  # We're supposed to return at most this much
-                chunk = self.leftover or next(iterable)
-                output, self.leftover = chunk[:ln], chunk[ln:]
-                b[:len(output)] = output
+                while self.leftover is None or self.pos >= len(self.leftover):
+                    self.leftover = memoryview(next(iterable))
+                    self.pos = 0
+                ln = min(len(b), len(self.leftover) - self.pos)  # We're supposed to return at most len(b)
+                b[:ln] = self.leftover[self.pos:self.pos + ln]
+                self.pos += ln
                 if progressbar:
-                    progressbar.update(len(output))
-                return len(output)
+                    progressbar.update(ln)
+                return ln
             except StopIteration:
                 return 0  # indicate EOF
 
+        def readall(self):
+            # used by `read()` without size: join all remaining chunks at once instead of looping on `readinto`
+            parts = []
+            if self.leftover is not None and self.pos < len(self.leftover):
+                parts.append(self.leftover[self.pos:].tobytes())
+            self.leftover = None
+            parts.extend(iterable)
+            data = b"".join(parts)
+            if progressbar:
+                progressbar.update(len(data))
+            return data
+
     return io.BufferedReader(IterStream(), buffer_size=buffer_size)
 
 
+@contextmanager
+def _tmp_file_replacing(file_path  # type: str
+                        ):
+    """
+    Yields the path of a temporary file to write, next to `file_path`. It replaces `file_path` only at the end if no
+    error happened: this way an interrupted write (for example a download) does not leave a truncated file behind.
+    The temporary file is removed in case of error.
+    """
+    tmp_file_path = "%s.%s.tmp" % (file_path, uuid4().hex)
+    try:
+        yield tmp_file_path
+        _replace_file(tmp_file_path, file_path)
+    finally:
+        if os.path.exists(tmp_file_path):
+            # something went wrong
+            os.remove(tmp_file_path)
+
+
 class CacheFileNotFoundError(FileNotFoundError):
     pass
 
 
+class _FileLock(object):
+    """A lock shared by all `CacheEntry` objects pointing to the same file, see `_get_file_lock`"""
+    __slots__ = ('acquire', 'release', '__weakref__')
+
+    def __init__(self):
+        lock = Lock()
+        self.acquire = lock.acquire
+        self.release = lock.release
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+_FILE_LOCKS = WeakValueDictionary()  # type: WeakValueDictionary[str, _FileLock]
+_FILE_LOCKS_GUARD = Lock()
+
+
+def _get_file_lock(file_path  # type: Union[str, Path]
+                   ):
+    # type: (...) -> _FileLock
+    """
+    Returns the lock to use for `file_path`. It is the same object for all callers as long as one of them references
+    it, so that two `CacheEntry` objects for the same file (for example created by two different clients) really
+    protect each other.
+    """
+    key = os.path.abspath(str(file_path))
+    with _FILE_LOCKS_GUARD:
+        lock = _FILE_LOCKS.get(key)
+        if lock is None:
+            lock = _FILE_LOCKS[key] = _FileLock()
+        return lock
+
+
 class CacheEntry(object):
     """
     Represents a cache entry for a dataset, under `cache_root` (default CACHE_ROOT_FOLDER).
     It may not exist.
 
-    Access to the file are thread-safe (atomic) to avoid collisions while the file is updated.
+    Access to the file are thread-safe (atomic) to avoid collisions while the file is updated. All entries for the
+    same file share the same lock.
     """
-    __slots__ = ('dataset_id', 'dataset_format', 'platform_pseudo_id', '_cache_root', 'rw_lock')
+    __slots__ = ('dataset_id', 'dataset_format', 'platform_pseudo_id', '_cache_root', '_file_path', 'rw_lock')
 
     def __init__(self,
                  dataset_id,          # type: str
@@ -908,7 +1542,6 @@ class CacheEntry(object):
         self.dataset_id = dataset_id
         self.dataset_format = dataset_format
         self.platform_pseudo_id = platform_pseudo_id
-        self.rw_lock = Lock()
 
         if cache_root is None:
             self._cache_root = None
@@ -917,6 +1550,10 @@ class CacheEntry(object):
                 cache_root = Path(cache_root)
             self._cache_root = cache_root
 
+        # the file path never changes: compute it once
+        self._file_path = Path("%s/%s/%s.%s" % (self.cache_root, platform_pseudo_id, dataset_id, dataset_format))
+        self.rw_lock = _get_file_lock(self._file_path)
+
     def __repr__(self):
         return "CacheEntry(path='%s')" % self.file_path
 
@@ -935,7 +1572,7 @@ class CacheEntry(object):
     def file_path(self):
         # type: (...) -> Path
         """The file where this entry sits (it may exist or not)"""
-        return Path("%s/%s/%s.%s" % (self.cache_root, self.platform_pseudo_id, self.dataset_id, self.dataset_format))
+        return self._file_path
 
     def assert_exists(self):
         """Raises an error if the file does not exist"""
@@ -943,17 +1580,28 @@ class CacheEntry(object):
             raise CacheFileNotFoundError("Cached file entry can not be read as it does not exist: '%s'"
                                          % self.file_path)
 
-    def read(self):
+    def read(self,
+             lock=True  # type: bool
+             ):
         # type: (...) -> str
         """
         Returns a string read from the cached file.
         Preserve line endings thanks to newline='' see See https://stackoverflow.com/a/50996542/7262247
+
+        :param lock: if `False`, `self.rw_lock` is not acquired (for callers already holding it)
         """
-        with self.rw_lock:  # potentially wait for ongoing write/read to be completed, and prevent others to happen
-            self.assert_exists()
-            with self.file_path.open(mode="rt", newline='', encoding=CACHE_ENCODING) as f:
-                result = f.read()
-            return result
+        if lock:
+            with self.rw_lock:  # potentially wait for ongoing write/read to be completed, and prevent others to happen
+                return self._read_no_lock()
+        else:
+            return self._read_no_lock()
+
+    def _read_no_lock(self):
+        # type: (...) -> str
+        """The no-lock version of read"""
+        self.assert_exists()
+        with self.file_path.open(mode="rt", newline='', encoding=CACHE_ENCODING) as f:
+            return f.read()
 
     def copy_to_file(self,
                      file_path  # type: Union[str, Path]
@@ -964,7 +1612,8 @@ class CacheEntry(object):
         """
         with self.rw_lock:  # potentially wait for ongoing write/read to be completed, and prevent others to happen
             self.assert_exists()
-            copyfile(str(self.file_path), str(file_path))
+            with _tmp_file_replacing(str(file_path)) as tmp_file_path:
+                copyfile(str(self.file_path), tmp_file_path)
 
     def delete(self):
         """
@@ -987,6 +1636,17 @@ class CacheEntry(object):
         # make sure the parents exist
         self.file_path.parent.mkdir(parents=True, exist_ok=True)
 
+    @contextmanager
+    def _tmp_file_for_writing(self):
+        """
+        Prepares for writing (see `prepare_for_writing`) and yields the path of a temporary file to write, that
+        replaces `self.file_path` only if no error happened (see `_tmp_file_replacing`). This way an interrupted write
+        does not leave a truncated file behind, that would be read as a valid entry.
+        """
+        self.prepare_for_writing()
+        with _tmp_file_replacing(str(self.file_path)) as tmp_file_path:
+            yield tmp_file_path
+
     def fill_from_str(self,
                       txt_initial_encoding,  # type: str
                       decoded_txt,           # type: str
@@ -996,13 +1656,14 @@ class CacheEntry(object):
         If the original encoding is not equal to the cache encoding, a warning is issued.
         """
         with self.rw_lock:  # potentially wait for ongoing write/read to be completed, and prevent others to happen
-            self.prepare_for_writing()
-            # Our cache uses utf-8 for all files, in order not to have to remember encodings to read back
-            if txt_initial_encoding != CACHE_ENCODING:
-                self.warn_encoding(original_encoding=txt_initial_encoding, cache_encoding=CACHE_ENCODING)
+            with self._tmp_file_for_writing() as tmp_file_path:
+                # Our cache uses utf-8 for all files, in order not to have to remember encodings to read back
+                if txt_initial_encoding != CACHE_ENCODING:
+                    self.warn_encoding(original_encoding=txt_initial_encoding, cache_encoding=CACHE_ENCODING)
 
-            # copy with the correct encoding
-            self.file_path.write_bytes(decoded_txt.encode(CACHE_ENCODING))
+                # copy with the correct encoding
+                with open(tmp_file_path, 'wb') as f:
+                    f.write(decoded_txt.encode(CACHE_ENCODING))
 
     def _fill_from_it_no_lock(self,
                               it,                 # type: Iterable
@@ -1011,28 +1672,25 @@ class CacheEntry(object):
                               ):
         """The no-lock version of fill from iterable"""
 
-        self.prepare_for_writing()
-        if it_encoding == CACHE_ENCODING:
-            # no encoding change: direct copy
-            with open(str(self.file_path), 'wb') as f:  # stream to csv file in binary mode
-                for data in it:  # block by block
-                    if progress_bar:
-                        progress_bar.update(len(data))  # - update progress bar
-                    f.write(data)  # - direct copy (no decoding/encoding)
-        else:
-            # Our cache uses utf-8 for all files, in order not to have to remember encodings to read back
-            self.warn_encoding(original_encoding=it_encoding, cache_encoding=CACHE_ENCODING)
-
-            # we will need transcoding. Fully stream to memory string and dump to cache and datframe after
-            csv_str_io = io.StringIO()  # stream to a string in memory
-            for data in it:  # block by block
-                if progress_bar:
-                    progress_bar.update(len(data))  # - update progress bar
-                csv_str_io.write(data.decode(it_encoding))  # - decode with proper encoding
-            csv_str = csv_str_io.getvalue()
+        with self._tmp_file_for_writing() as tmp_file_path:
+            with open(tmp_file_path, 'wb') as f:  # stream to csv file in binary mode
+                if it_encoding == CACHE_ENCODING:
+                    # no encoding change: direct copy
+                    for data in it:  # block by block
+                        if progress_bar:
+                            progress_bar.update(len(data))  # - update progress bar
+                        f.write(data)  # - direct copy (no decoding/encoding)
+                else:
+                    # Our cache uses utf-8 for all files, in order not to have to remember encodings to read back
+                    self.warn_encoding(original_encoding=it_encoding, cache_encoding=CACHE_ENCODING)
 
-            # store in cache with proper encoding
-            self.file_path.write_bytes(csv_str.encode(CACHE_ENCODING))
+                    # we will need transcoding, block by block
+                    decoder = codecs.getincrementaldecoder(it_encoding)()  # multi-byte chars may be split in 2 blocks
+                    for data in it:  # block by block
+                        if progress_bar:
+                            progress_bar.update(len(data))  # - update progress bar
+                        f.write(decoder.decode(data).encode(CACHE_ENCODING))  # - decode and encode
+                    f.write(decoder.decode(b'', final=True).encode(CACHE_ENCODING))
 
     def fill_from_iterable(self,
                            it,                # type: Iterable
@@ -1041,11 +1699,13 @@ class CacheEntry(object):
                            lock=True
                            ):
         """
-        Fill this cache entry from an iterable of bytes
+        Fill this cache entry from an iterable of bytes. If `it_encoding` is not the cache encoding, the bytes are
+        transcoded block by block and a warning is issued.
+
         :param it:
         :param it_encoding:
         :param progress_bar:
-        :return: csv_str if it was streamed to memory in the process (if transcoding was needed)
+        :return:
         """
         if lock:
             with self.rw_lock:  # potentially wait for ongoing write/read to be completed, and prevent others to happen
@@ -1062,19 +1722,16 @@ class CacheEntry(object):
         If the original encoding is not equal to the cache encoding, conversion happens and a warning is issued.
         """
         with self.rw_lock:  # potentially wait for ongoing write/read to be completed, and prevent others to happen
-            self.prepare_for_writing()
             if file_encoding == CACHE_ENCODING:
                 # no encoding change: direct copy
-                copyfile(str(file_path), str(self.file_path))
+                with self._tmp_file_for_writing() as tmp_file_path:
+                    copyfile(str(file_path), tmp_file_path)
             else:
-                # Our cache uses utf-8 for all files, in order not to have to remember encodings to read back
-                self.warn_encoding(original_encoding=file_encoding, cache_encoding=CACHE_ENCODING)
-                # read with newline-preserve and with original encoding
-                with open(str(file_path), mode="rt", newline='', encoding=file_encoding) as f_src:
-                    contents = f_src.read()
-                # write with the cache encoding
-                with open(str(self.file_path), mode='wt', encoding=CACHE_ENCODING) as f_dest:
-                    f_dest.write(contents)
+                # transcode the file block by block, in binary mode so that line endings are preserved (this also warns
+                # about the encoding change)
+                with open(str(file_path), mode='rb') as f_src:
+                    self._fill_from_it_no_lock(iter(partial(f_src.read, STREAM_CHUNK_SIZE), b''),
+                                               it_encoding=file_encoding)
 
     def warn_encoding(self, original_encoding, cache_encoding):
         """
@@ -1088,6 +1745,7 @@ class CacheEntry(object):
             % (self.dataset_id, cache_encoding, original_encoding))
 
 
+@lru_cache(maxsize=128)
 def baseurl_to_id_str(base_url):
     """ Transform an ODS platform url into an identifier string usable for example as file/folder name"""
 
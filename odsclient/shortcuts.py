@@ -117,6 +117,7 @@ def get_whole_dataframe(dataset_id,                                    # type: s
                         tqdm=False,                                    # type: bool
                         block_size=1024,                               # type: int
                         file_cache=False,                              # type: bool
+                        csv_engine=None,                               # type: str
                         platform_id='public',                          # type: str
                         base_url=None,                                 # type: str
                         enforce_apikey=False,                          # type: bool
@@ -136,6 +137,7 @@ def get_whole_dataframe(dataset_id,                                    # type: s
     :param use_labels_for_header:
     :param tqdm: a boolean indicating if a progress bar using tqdm should be displayed. tqdm should be installed
     :param block_size: an int block size used in streaming mode when to_csv or tqdm is used
+    :param csv_engine: an optional parser engine to use in `pandas.read_csv`, for example `'pyarrow'`.
     :param platform_id: the ods platform id to use. This id is used to construct the base URL based on the pattern
         https://<platform_id>.opendatasoft.com. Default is `'public'` which leads to the base url
         https://public.opendatasoft.com
@@ -151,11 +153,12 @@ def get_whole_dataframe(dataset_id,                                    # type: s
         the base url for the service id, however the user name can be anything. By default we use a string:
         'apikey_user'.
     :param requests_session: an optional `Session` object to use (from `requests` lib). If `None` is provided,
-            a new `Session` will be used and deleted when this object is garbaged out. If a custom object is provided,
-            you should close it yourself or switch `auto_close_session` to `True` explicitly.
+            a new `Session` using the transport adapter shared by all clients will be used (see `get_default_adapter`).
+            If a custom object is provided, you should close it yourself or switch `auto_close_session` to `True`
+            explicitly.
     :param auto_close_session: an optional boolean indicating if `self.session` should be closed when this object
-        is garbaged out. By default this is `None` and means "`True` if no custom `requests_session` is passed, else
-        `False`"). Turning this to `False` can leave hanging Sockets unclosed.
+        is garbaged out. By default this is `None` and means `False`: the shared default adapter is closed at exit,
+        and custom sessions should be closed by their owner.
     :param other_opts:
     :return:
     """
@@ -163,7 +166,8 @@ def get_whole_dataframe(dataset_id,                                    # type: s
                        apikey_filepath=apikey_filepath, use_keyring=use_keyring, auto_close_session=auto_close_session,
                        keyring_entries_username=keyring_entries_username, requests_session=requests_session)
     return client.get_whole_dataframe(dataset_id=dataset_id, use_labels_for_header=use_labels_for_header,
-                                      tqdm=tqdm, block_size=block_size, file_cache=file_cache, **other_opts)
+                                      tqdm=tqdm, block_size=block_size, file_cache=file_cache, csv_engine=csv_engine,
+                                      **other_opts)
 
 
 def clean_cache(dataset_id=None,   # type: str
@@ -242,6 +246,7 @@ def get_whole_dataset(dataset_id,                                    # type: str
                       to_path=None,                                  # type: Union[str, Path]
                       file_cache=False,                              # type: bool
                       block_size=1024,                               # type: int
+                      as_stream=False,                               # type: bool
                       platform_id='public',                          # type: str
                       base_url=None,                                 # type: str
                       enforce_apikey=False,                          # type: bool
@@ -267,6 +272,8 @@ def get_whole_dataset(dataset_id,                                    # type: str
     :param file_cache: a boolean (default False) indicating whether the file should be written to a local cache
         `.odsclient/<pseudo_platform_id>_<dataset_id>.<format>`. See `get_cached_datasset_entry` for details.
     :param block_size: an int block size used in streaming mode when to_csv or tqdm is used
+    :param as_stream: a boolean (default False) indicating that the binary file-like object `response.raw` should be
+        returned instead of a string. This can not be used with `tqdm`, `to_path` or `file_cache`.
     :param platform_id: the ods platform id to use. This id is used to construct the base URL based on the pattern
         https://<platform_id>.opendatasoft.com. Default is `'public'` which leads to the base url
         https://public.opendatasoft.com
@@ -282,11 +289,12 @@ def get_whole_dataset(dataset_id,                                    # type: str
         the base url for the service id, however the user name can be anything. By default we use a string:
         'apikey_user'.
     :param requests_session: an optional `Session` object to use (from `requests` lib). If `None` is provided,
-            a new `Session` will be used and deleted when this object is garbaged out. If a custom object is provided,
-            you should close it yourself or switch `auto_close_session` to `True` explicitly.
+            a new `Session` using the transport adapter shared by all clients will be used (see `get_default_adapter`).
+            If a custom object is provided, you should close it yourself or switch `auto_close_session` to `True`
+            explicitly.
     :param auto_close_session: an optional boolean indicating if `self.session` should be closed when this object
-        is garbaged out. By default this is `None` and means "`True` if no custom `requests_session` is passed, else
-        `False`"). Turning this to `False` can leave hanging Sockets unclosed.
+        is garbaged out. By default this is `None` and means `False`: the shared default adapter is closed at exit,
+        and custom sessions should be closed by their owner.
     :param other_opts:
     :return:
     """
@@ -296,7 +304,7 @@ def get_whole_dataset(dataset_id,                                    # type: str
     return client.get_whole_dataset(dataset_id=dataset_id, format=format, file_cache=file_cache,
                                     timezone=timezone, use_labels_for_header=use_labels_for_header,
                                     csv_separator=csv_separator, tqdm=tqdm, to_path=to_path, block_size=block_size,
-                                    **other_opts)
+                                    as_stream=as_stream, **other_opts)
 
 
 def push_dataset_realtime(platform_id,        # type: str
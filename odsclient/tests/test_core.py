@@ -1,10 +1,18 @@
+import csv
+import io
+import json
 import os
+import subprocess
+import sys
 
 import pytest
 import requests
+from urllib3 import HTTPResponse
 
-from odsclient import get_whole_dataset, ODSException, NoODSAPIKeyFoundError, InsufficientRightsForODSResourceError
-from odsclient.core import baseurl_to_id_str
+from odsclient import get_whole_dataset, ODSClient, ODSException, NoODSAPIKeyFoundError, \
+    InsufficientRightsForODSResourceError
+import odsclient.core
+from odsclient.core import baseurl_to_id_str, CacheEntry, _csv_to_records, iterable_to_stream, _normalize_apikey
 
 
 def test_error_bad_dataset_id():
@@ -41,6 +49,7 @@ def test_bad_apikey():
 
 
 # @pytest.mark.skipif('TRAVIS_PYTHON_VERSION' in os.environ, reason="Does not work yet on travis")
+@pytest.mark.xdist_group("shared_state")  # shares the keyring with others, see test_readme.py
 def test_keyring_unit():
     """Small unit test for keyring"""
     import keyring
@@ -50,6 +59,65 @@ def test_keyring_unit():
     assert keyring.get_password(base_url, 'apikey') == 'blah'
 
 
+def test_optional_deps_not_imported():
+    """Checks that importing odsclient does not import the optional dependencies, so that it stays fast"""
+    code = "import sys, odsclient; " \
+           "print(','.join(m for m in ('keyring', 'click', 'tqdm', 'pandas') if m in sys.modules))"
+    imported = subprocess.check_output([sys.executable, "-c", code]).decode("utf-8").strip()
+    assert imported == ""
+
+
+def test_cache_fill_split_multibyte_chars(tmpdir):
+    """Checks that characters split across two blocks are correctly decoded when the cache is filled"""
+    txt = u"\xff\xe9;\u6f22\u5b57\n" * 3
+    data = txt.encode("utf-16")
+    entry = CacheEntry(dataset_id="ds", dataset_format="csv", platform_pseudo_id="pf", cache_root=str(tmpdir))
+    with pytest.warns(UserWarning):  # transcoding warning
+        entry.fill_from_iterable((data[i:i + 3] for i in range(0, len(data), 3)), it_encoding="utf-16")
+    assert entry.read() == txt
+
+
+def test_cache_fill_from_file_transcoding(tmpdir):
+    """Checks that a file in another encoding is correctly transcoded to the cache, with its line endings preserved"""
+    txt = u"a;\xe9\r\nb;\xe8\r\n"
+    src = tmpdir.join("src.csv")
+    src.write_binary(txt.encode("latin-1"))
+    entry = CacheEntry(dataset_id="ds", dataset_format="csv", platform_pseudo_id="pf", cache_root=str(tmpdir))
+    with pytest.warns(UserWarning):  # transcoding warning
+        entry.fill_from_file(str(src), file_encoding="latin-1")
+    assert entry.file_path.read_bytes() == txt.encode("utf-8")
+
+
+def test_cache_entries_share_locks(tmpdir):
+    """Checks that all cache entries for the same file share the same lock"""
+    e1 = CacheEntry(dataset_id="ds", dataset_format="csv", platform_pseudo_id="pf", cache_root=str(tmpdir))
+    e2 = CacheEntry(dataset_id="ds", dataset_format="csv", platform_pseudo_id="pf", cache_root=str(tmpdir))
+    e3 = CacheEntry(dataset_id="ds2", dataset_format="csv", platform_pseudo_id="pf", cache_root=str(tmpdir))
+    assert e1.rw_lock is e2.rw_lock
+    assert e1.rw_lock is not e3.rw_lock
+    with e1.rw_lock:
+        assert not e2.rw_lock.acquire(False)
+        assert e3.rw_lock.acquire(False)
+        e3.rw_lock.release()
+    assert e2.rw_lock.acquire(False)
+    e2.rw_lock.release()
+
+
+def test_cache_fill_interrupted(tmpdir):
+    """Checks that an interrupted download does not modify the existing cache entry nor leave temporary files"""
+    entry = CacheEntry(dataset_id="ds", dataset_format="csv", platform_pseudo_id="pf", cache_root=str(tmpdir))
+    entry.fill_from_iterable(iter([b"a;b\n"]), it_encoding="utf-8")
+
+    def interrupted_download():
+        yield b"c;d\n"
+        raise IOError("connection lost")
+
+    with pytest.raises(IOError), pytest.warns(UserWarning):  # entry overridden warning
+        entry.fill_from_iterable(interrupted_download(), it_encoding="utf-8")
+    assert entry.read() == "a;b\n"
+    assert [f.basename for f in tmpdir.join("pf").listdir()] == ["ds.csv"]
+
+
 @pytest.mark.parametrize("protocol", ["http://", "ftp://", "https://"])
 @pytest.mark.parametrize("ending_slash", [False, True])
 def test_baseurl_to_id_str(protocol, ending_slash):
@@ -64,3 +132,423 @@ def test_baseurl_to_id_str(protocol, ending_slash):
         base_url += "/"
     pseudo_id = baseurl_to_id_str(base_url)
     assert pseudo_id == "data.exchange.se.com_ho"
+
+
+@pytest.mark.parametrize("csv_txt", ["", "a;b;c", "a;b;c\n1;2;3\n\n4;5\n6;7;8;9;10\n;\n\n", "\na;b\n1;2;3\n\n",
+                                     "a;a;b\n1;2;3\n4\n"], ids=["empty", "header_only", "mixed", "blank_first",
+                                                                  "dup_keys"])
+def test_csv_to_records(csv_txt):
+    """Checks that `_csv_to_records` yields the same records as `csv.DictReader`, on blank, short and long rows"""
+    ref = list(csv.DictReader(csv_txt.splitlines(), delimiter=";"))
+    assert _csv_to_records(csv.reader(csv_txt.splitlines(), delimiter=";")) == [dict(r) for r in ref]
+
+
+@pytest.mark.parametrize("first_read", [0, 1, 3, 5, 100], ids="first_read={}".format)
+@pytest.mark.parametrize("n", [1, 3, 4, 7, 100], ids="n={}".format)
+def test_iterable_to_stream(n, first_read):
+    """Checks `iterable_to_stream` with chunks larger than the buffer, empty chunks and EOF, with read(n) and read()"""
+    chunks = [b"", b"abcdefghij", b"", b"", b"k", b"lmnopqrstuvwxyz0123", b""]
+    expected = b"".join(chunks)
+
+    class ProgressBar(object):
+        n = 0
+
+        def update(self, k):
+            self.n += k
+
+    # read(n) until EOF
+    bar = ProgressBar()
+    stream = iterable_to_stream(iter(chunks), buffer_size=4, progressbar=bar)
+    parts = []
+    while True:
+        part = stream.read(n)
+        assert len(part) <= n
+        if not part:
+            break
+        parts.append(part)
+    assert b"".join(parts) == expected
+    assert bar.n == len(expected)
+    assert stream.read(n) == b"" and stream.read() == b""
+
+    # read(first_read) then read() the rest
+    bar = ProgressBar()
+    stream = iterable_to_stream(iter(chunks), buffer_size=4, progressbar=bar)
+    start = stream.read(first_read)
+    assert start == expected[:first_read]
+    assert start + stream.read() == expected
+    assert bar.n == len(expected)
+    assert stream.read() == b"" and stream.read(n) == b""
+
+
+class StubSession(object):
+    """
+    A minimal offline replacement for `requests.Session`: records the requests and returns a fixed response. `content`
+    is the body, as bytes or as a binary file-like object.
+    """
+
+    def __init__(self, content=b"", content_type="text/csv; charset=utf-8", status_code=200, headers=None):
+        self.content = content
+        self.content_type = content_type
+        self.status_code = status_code
+        self.headers = headers or dict()
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.url = url
+        response.headers['Content-Type'] = self.content_type
+        response.headers.update(self.headers)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        body = io.BytesIO(self.content) if isinstance(self.content, bytes) else self.content
+        response.raw = HTTPResponse(body=body, headers=dict(response.headers),
+                                    status=self.status_code, preload_content=False)
+        return response
+
+    def close(self):
+        pass
+
+
+def stub_client(session=None, **kwargs):
+    """
+    Returns an `ODSClient` using `session` (default: a new `StubSession`). Unless `kwargs` specify otherwise, it
+    does not look for an api key in a file nor in the keyring.
+    """
+    opts = dict(apikey_filepath=None, use_keyring=False)
+    opts.update(kwargs)
+    return ODSClient(base_url="https://stub.example.com/", requests_session=session or StubSession(), **opts)
+
+
+@pytest.mark.parametrize("use_orjson", [False, True], ids="orjson={}".format)
+def test_push_csv_long_row(monkeypatch, use_orjson):
+    """Checks that a csv row longer than the header (extra fields with a `None` key) can be pushed"""
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(odsclient.core, "orjson_dumps", None)
+
+    client = stub_client(StubSession(content=b"{}", content_type="application/json"))
+    client.push_dataset_realtime("ds", u"a;b\n1;2;3;4\n5;\xe9\n", format="csv", push_key="pk")
+    body = client.session.requests[0][2]["data"]
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+    assert json.loads(body) == [{u"a": u"1", u"b": u"2", u"null": [u"3", u"4"]}, {u"a": u"5", u"b": u"\xe9"}]
+
+
+@pytest.mark.parametrize("mode", ["small", "streamed", "file_cache"])
+def test_dataframe_no_charset(tmpdir, mode):
+    """Checks that a csv received without charset is decoded as utf-8, not as the ISO-8859-1 default of requests"""
+    pytest.importorskip("pandas")
+    content = u"a;b\n1;\xe9\u6f22\n".encode("utf-8")
+    client = stub_client(StubSession(content=content, content_type="text/csv",
+                                     headers={"Content-Length": str(len(content))} if mode == "small" else None))
+    df = client.get_whole_dataframe("ds", file_cache=str(tmpdir) if mode == "file_cache" else False)
+    assert df["b"][0] == u"\xe9\u6f22"
+
+
+@pytest.mark.parametrize("tqdm", [False, True], ids="tqdm={}".format)
+@pytest.mark.parametrize("file_cache", [False, True], ids="file_cache={}".format)
+def test_dataset_no_charset(tmpdir, file_cache, tqdm):
+    """Checks that `get_whole_dataset` decodes a csv received without charset as utf-8, on all paths"""
+    if tqdm:
+        pytest.importorskip("tqdm")
+    csv_str = u"a;b\n1;\xe9\u6f22\n"
+    content = csv_str.encode("utf-8")
+    client = stub_client(StubSession(content=content, content_type="text/csv",
+                                     headers={"Content-Length": str(len(content))}))
+    cache_root = str(tmpdir.join("cache")) if file_cache else False
+    assert client.get_whole_dataset("ds", file_cache=cache_root, tqdm=tqdm) == csv_str
+    if file_cache:
+        assert client.get_cached_dataset_entry("ds", "csv", cache_root).read() == csv_str
+
+
+class FakeKeyring(object):
+    """A minimal in-memory replacement for the `keyring` module"""
+
+    def __init__(self, entries=None):
+        self.entries = entries or dict()
+
+    def get_password(self, service_name, username):
+        return self.entries.get((service_name, username))
+
+    def set_password(self, service_name, username, password):
+        self.entries[(service_name, username)] = password
+
+
+def test_normalize_apikey(tmpdir, monkeypatch):
+    """Checks that blank api keys are normalized to None, and that each source keeps its behaviour on them"""
+    for apikey in (None, "", "  ", " \r\n\t"):
+        assert _normalize_apikey(apikey) is None
+    assert _normalize_apikey(" k \r\n") == "k"
+
+    # explicit argument and file: blanks are removed, and an error is raised if the key is empty
+    with pytest.raises(ValueError):
+        ODSClient(apikey=" \n")
+    apikey_file = tmpdir.join("ods.apikey")
+    apikey_file.write("\n")
+    with pytest.raises(ValueError):
+        ODSClient(apikey_filepath=str(apikey_file))
+    apikey_file.write(" k1 \n")
+    assert ODSClient(apikey_filepath=str(apikey_file)).apikey == "k1"
+
+    # environment variable, as a string or as a dict: same
+    client = stub_client()
+    for env_value in (" ", "{'default': ' '}"):
+        monkeypatch.setenv("ODS_APIKEY", env_value)
+        with pytest.raises(ValueError):
+            client.get_apikey_from_envvar()
+    monkeypatch.setenv("ODS_APIKEY", "{'default': ' k2\\n'}")
+    assert client.get_apikey_from_envvar() == "k2"
+
+    # keyring: an error is raised when storing an empty key, and an empty entry is ignored
+    fake_keyring = FakeKeyring()
+    monkeypatch.setattr(odsclient.core, "_keyring", fake_keyring)
+    client = stub_client(use_keyring=True)
+    with pytest.raises(ValueError):
+        client.store_apikey_in_keyring(" \n")
+    fake_keyring.set_password(client.base_url, client.keyring_entries_username, " ")
+    assert client.get_apikey_from_keyring() is None
+    assert client.get_apikey() == "k2"  # from the environment variable
+    client.store_apikey_in_keyring(" k3 ")
+    assert client.get_apikey_from_keyring() == "k3"
+    assert client.get_apikey() == "k3"
+
+
+def test_env_apikeys_changed(monkeypatch):
+    """Checks that a change of the dict-like 'ODS_APIKEY' environment variable is taken into account"""
+    client = stub_client(cache_apikey=False)
+    monkeypatch.setenv("ODS_APIKEY", "{'default': 'k1'}")
+    assert client.get_apikey() == "k1"
+    assert client.get_apikey() == "k1"  # the parsed dict is reused
+    monkeypatch.setenv("ODS_APIKEY", "{'default': 'k2', 'https://stub.example.com/': 'k3'}")
+    assert client.get_apikey() == "k3"
+    monkeypatch.setenv("ODS_APIKEY", "{'default': 'k1'}")
+    assert client.get_apikey() == "k1"
+    monkeypatch.delenv("ODS_APIKEY")
+    assert client.get_apikey() is None
+
+
+def test_apikey_cache(monkeypatch):
+    """Checks that the api key found is reused when `cache_apikey=True`, until `invalidate_apikey_cache` is called"""
+    lookups = []
+    monkeypatch.setenv("ODS_APIKEY", "k1")
+    client = stub_client()
+    real_lookup = client._lookup_apikey
+
+    def counting_lookup():
+        lookups.append(1)
+        return real_lookup()
+
+    monkeypatch.setattr(client, "_lookup_apikey", counting_lookup)
+    assert client.get_apikey() == "k1"
+    monkeypatch.setenv("ODS_APIKEY", "k2")
+    assert client.get_apikey() == "k1"  # cached
+    assert len(lookups) == 1
+
+    client.invalidate_apikey_cache()
+    assert client.get_apikey() == "k2"
+    assert client.get_apikey() == "k2"
+    assert len(lookups) == 2
+
+    # the absence of api key is cached too
+    monkeypatch.delenv("ODS_APIKEY")
+    client.invalidate_apikey_cache()
+    assert client.get_apikey() is None
+    monkeypatch.setenv("ODS_APIKEY", "k3")
+    assert client.get_apikey() is None
+    assert len(lookups) == 3
+
+
+def test_apikey_headers(monkeypatch):
+    """Checks the authentication headers with no api key, an explicit one, and one found lazily"""
+    monkeypatch.delenv("ODS_APIKEY", raising=False)
+    assert stub_client().get_apikey_headers() is None
+
+    client = stub_client(apikey="k1", apikey_filepath="ods.apikey")
+    assert client.get_apikey_headers() == {"Authorization": "Apikey k1"}
+
+    client = stub_client()
+    monkeypatch.setenv("ODS_APIKEY", "k2")
+    assert client.get_apikey_headers() == {"Authorization": "Apikey k2"}
+    client.get_whole_dataset("ds")
+    assert client.session.requests[-1][2]["headers"] == {"Authorization": "Apikey k2"}
+
+
+def test_download_url_reserved_chars():
+    """Checks that the reserved and non-ascii characters of dataset ids are percent-encoded in the download url"""
+    client = stub_client()
+    url = client.get_download_url(u"a b/c?d#e%f&g+h=\xe9")
+    assert url == "https://stub.example.com/explore/dataset/a%20b%2Fc%3Fd%23e%25f%26g%2Bh%3D%C3%A9/download/"
+    assert client.get_download_url(u"a b/c?d#e%f&g+h=\xe9") is url
+
+    client.get_whole_dataset(u"a b/c?d#e%f&g+h=\xe9")
+    assert client.session.requests[-1][1] == url
+
+
+def test_push_url_reserved_chars():
+    """Checks that the reserved and non-ascii characters of dataset ids are percent-encoded in the push url"""
+    client = stub_client(StubSession(content=b"{}", content_type="application/json"))
+    client.push_dataset_realtime(u"a b/c?d#e%f&g+h=\xe9", u"a;b\n1;2\n", format="csv", push_key="pk")
+    assert client.session.requests[0][1] == ("https://stub.example.com/api/push/1.0/"
+                                             "a%20b%2Fc%3Fd%23e%25f%26g%2Bh%3D%C3%A9/realtime/push/")
+
+
+def test_get_many_datasets(monkeypatch):
+    """Checks that `get_many_datasets` returns each result or error under its dataset id, in any completion order"""
+    import time
+    client = stub_client()
+    dataset_ids = ["ds%s" % i for i in range(10)] + ["bad"]
+
+    def stub_get_whole_dataset(dataset_id, **kwargs):
+        if dataset_id == "bad":
+            raise ODSException(404, dict(), error="Unknown dataset: bad")
+        i = int(dataset_id[2:])
+        time.sleep(0.001 * (10 - i))  # the first datasets end last
+        return "%s,%s" % (dataset_id, kwargs["format"])
+
+    monkeypatch.setattr(client, "get_whole_dataset", stub_get_whole_dataset)
+    results = client.get_many_datasets(dataset_ids, max_workers=4, format="csv")
+    assert sorted(results) == sorted(dataset_ids)
+    for dataset_id in dataset_ids[:-1]:
+        assert results[dataset_id] == "%s,csv" % dataset_id
+    assert isinstance(results["bad"], ODSException)
+    assert results["bad"].error_msg == "Unknown dataset: bad"
+
+    with pytest.raises(ValueError):
+        client.get_many_datasets(dataset_ids, to_path="foo.csv")
+
+
+def test_get_many_datasets_pool_warning(recwarn):
+    """Checks that `get_many_datasets` warns when there are more workers than connections in the pool"""
+    client = ODSClient(pool_maxsize=2)
+    assert client._pool_maxsize == 2
+    client.get_many_datasets([], max_workers=3)
+    assert len(recwarn) == 1 and "pool size (2)" in str(recwarn.pop(UserWarning).message)
+    client.get_many_datasets([], max_workers=2)
+    assert ODSClient(max_retries=0)._pool_maxsize == 16
+    assert ODSClient()._pool_maxsize == 50
+    stub_client().get_many_datasets([], max_workers=100)  # unknown pool size
+    assert len(recwarn) == 0
+
+
+def test_get_whole_dataset_bytes():
+    """Checks that `get_whole_dataset_bytes` returns the bytes received unchanged, only decompressed"""
+    import gzip
+    content = u"a;b\n1;\xe9\n".encode("latin-1")
+    client = stub_client(StubSession(content=content, content_type="text/csv; charset=iso-8859-1"))
+    assert client.get_whole_dataset_bytes("ds") == content
+
+    gz = io.BytesIO()
+    with gzip.GzipFile(fileobj=gz, mode="wb") as f:
+        f.write(content)
+    client = stub_client(StubSession(content=gz.getvalue(), headers={"Content-Encoding": "gzip"}))
+    assert client.get_whole_dataset_bytes("ds") == content
+
+
+class BrokenBody(io.BytesIO):
+    """A response body raising an error at the second read, as if the connection was lost"""
+
+    def read(self, *args, **kwargs):
+        if self.tell() > 0:
+            raise IOError("connection lost")
+        return io.BytesIO.read(self, *args, **kwargs)
+
+
+@pytest.mark.parametrize("tqdm", [False, True], ids="tqdm={}".format)
+def test_download_dataset_to_file(tmpdir, tqdm):
+    """Checks that `download_dataset_to_file` writes the bytes received, and leaves no file behind on error"""
+    if tqdm:
+        pytest.importorskip("tqdm")
+    content = u"a;b\n1;\xe9\n".encode("latin-1")
+    target = tmpdir.join("sub", "ds.csv")
+    client = stub_client(StubSession(content=content, content_type="text/csv; charset=iso-8859-1"))
+    client.download_dataset_to_file("ds", str(target), tqdm=tqdm)
+    assert target.read_binary() == content
+
+    # an interrupted download does not modify the existing file nor leave temporary files
+    client = stub_client(StubSession(content=BrokenBody(b"c;d\n" * 100)))
+    with pytest.raises(Exception, match="connection lost"):
+        client.download_dataset_to_file("ds", str(target), tqdm=tqdm)
+    assert target.read_binary() == content
+    assert [f.basename for f in target.dirpath().listdir()] == ["ds.csv"]
+
+    # same for a new file
+    client = stub_client(StubSession(content=BrokenBody(b"c;d\n" * 100)))
+    with pytest.raises(Exception, match="connection lost"):
+        client.download_dataset_to_file("ds2", str(tmpdir.join("ds2.csv")), tqdm=tqdm)
+    assert sorted(f.basename for f in tmpdir.listdir()) == ["sub"]
+
+
+def test_async_methods(monkeypatch):
+    """Checks that `aget_whole_dataset` and `aget_whole_dataframe` run the sync methods in the executor of the loop"""
+    asyncio = pytest.importorskip("asyncio")
+    import threading
+    client = stub_client()
+    threads = []
+
+    def stub_get_whole_dataset(dataset_id, **kwargs):
+        threads.append(threading.current_thread())
+        return "csv:%s:%s" % (dataset_id, sorted(kwargs.items()))
+
+    def stub_get_whole_dataframe(dataset_id, **kwargs):
+        threads.append(threading.current_thread())
+        if dataset_id == "bad":
+            raise ODSException(404, dict(), error="Unknown dataset: bad")
+        return "df:%s:%s" % (dataset_id, sorted(kwargs.items()))
+
+    monkeypatch.setattr(client, "get_whole_dataset", stub_get_whole_dataset)
+    monkeypatch.setattr(client, "get_whole_dataframe", stub_get_whole_dataframe)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        # the awaitables have to be created while the loop is running (no `async def` here, for python 2)
+        gathered = []
+        loop.call_soon(lambda: gathered.append(asyncio.gather(client.aget_whole_dataset("ds1", format="csv"),
+                                                              client.aget_whole_dataframe("ds2", tqdm=False),
+                                                              client.aget_whole_dataframe("bad"),
+                                                              return_exceptions=True)))
+        loop.run_until_complete(asyncio.sleep(0))
+        results = loop.run_until_complete(gathered[0])
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    assert results[:2] == ["csv:ds1:[('format', 'csv')]", "df:ds2:[('tqdm', False)]"]
+    assert isinstance(results[2], ODSException)
+    assert len(threads) == 3 and threading.current_thread() not in threads
+
+
+def test_default_sessions_share_adapter():
+    """Checks that clients without custom session have their own session, but share the same connection pool"""
+    c1, c2 = ODSClient(), ODSClient(base_url="https://data.exchange.se.com/", apikey="k")
+    assert c1.session is not c2.session
+    assert c1.session.get_adapter(c1.base_url) is c2.session.get_adapter(c2.base_url) \
+        is odsclient.core.get_default_adapter()
+    c1.session.cookies.set("name", "value")
+    assert len(c2.session.cookies) == 0
+    assert not c1.auto_close_session and not c2.auto_close_session
+
+
+def test_baseurl_to_id_str_bounded_memo():
+    """Checks that the memo of `baseurl_to_id_str` stays bounded"""
+    for i in range(300):
+        assert baseurl_to_id_str("https://host%s.opendatasoft.com/" % i) == "host%s" % i
+    if hasattr(baseurl_to_id_str, "cache_info"):  # python 3
+        assert baseurl_to_id_str.cache_info().currsize <= 128
+
+
+def test_cached_dataset_entries_bounded(monkeypatch, tmpdir):
+    """Checks that a client remembers its most recently used cache entries, up to `CACHE_ENTRIES_MAXSIZE`"""
+    monkeypatch.setattr(odsclient.core, "CACHE_ENTRIES_MAXSIZE", 3)
+    client = stub_client()
+    e1 = client.get_cached_dataset_entry("ds1", "csv", str(tmpdir))
+    e2 = client.get_cached_dataset_entry("ds2", "csv", str(tmpdir))
+    client.get_cached_dataset_entry("ds3", "csv", str(tmpdir))
+    assert client.get_cached_dataset_entry("ds1", "csv", str(tmpdir)) is e1  # ds1 is now the most recently used
+    client.get_cached_dataset_entry("ds4", "csv", str(tmpdir))  # ds2 is forgotten
+    assert len(client._cache_entries) == 3
+    assert client.get_cached_dataset_entry("ds1", "csv", str(tmpdir)) is e1
+    e2_bis = client.get_cached_dataset_entry("ds2", "csv", str(tmpdir))
+    assert e2_bis is not e2 and e2_bis.rw_lock is e2.rw_lock
@@ -3,6 +3,9 @@ from click.testing import CliRunner
 
 from odsclient.keyring_cmds import odskeys
 
+# these tests share the keyring with others: run them on the same worker when pytest-xdist is used
+pytestmark = pytest.mark.xdist_group("shared_state")
+
 
 @pytest.mark.parametrize('platform_id, base_url', [(None, None),
                                                    ('hello', None),
@@ -32,6 +32,9 @@ clean_cache()
 ALT_CACHE_ROOT = ".odscustcache"
 clean_cache(cache_root=ALT_CACHE_ROOT)
 
+# these tests share the keyring and cache folders: run them on the same worker when pytest-xdist is used
+pytestmark = pytest.mark.xdist_group("shared_state")
+
 
 def test_invalid_network_connection():
     """Tests that the make_invalid_network_session helper function works as expected"""
@@ -86,6 +89,11 @@ def test_example(save_to_file, progress_bar, tmp_path, file_cache):
     df2 = df2.set_index(['Office Name']).sort_index()
     pd.testing.assert_frame_equal(df, df2)
 
+    # same with another csv parser engine
+    df2 = get_whole_dataframe(dataset_id, tqdm=progress_bar, csv_engine='python')
+    df2 = df2.set_index(['Office Name']).sort_index()
+    pd.testing.assert_frame_equal(df, df2)
+
     # make sure the cached entry exists now and can be read without internet connection
     if cached_entry:
         # Make sure that the cache entry contains the dataset